@@ -0,0 +1,492 @@
+import json
+import struct
+import asyncio
+import logging
+from collections import OrderedDict
+import aiohttp
+from settings import SERVER_ADDRESS, COMFY_BACKENDS, COMFY_UI_PATH, INPUT_TRANSPORT, OUTPUT_TRANSPORT, DISPATCHER_RECONNECT_ATTEMPTS
+from websockets_api import client_id, save_images_to_db
+from submission_ledger import ledger
+from backend_pool import BackendPool
+from input_store import input_dir, prompt_inputs
+from output_store import local_output_path
+from workflow_templates import WEBSOCKET_SAVE_NODE
+
+logger = logging.getLogger(__name__)
+
+# One pooled HTTP session per process, created lazily on the running event loop
+_session = None
+
+def get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=10))
+    return _session
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+async def queue_prompt(prompt, request_id, server_address=SERVER_ADDRESS):
+    # The ledger guarantees at most one ComfyUI execution per API request; failover to another
+    # backend reuses the id, which is free again once the failed attempt released it
+    first, prompt_id = ledger.claim(request_id)
+    if not first:
+        logger.warning(f"Refusing duplicate submission for request {request_id}")
+        return {"prompt_id": prompt_id} if prompt_id else {}
+
+    p = {"prompt": prompt, "client_id": client_id}
+    try:
+        async with get_session().post(f"http://{server_address}/prompt", json=p) as response:
+            result = await response.json(content_type=None)
+            if response.status != 200:
+                # ComfyUI rejected the graph itself (node_errors); resubmitting elsewhere will not help
+                logger.error(f"ComfyUI rejected prompt: {result.get('error')} {result.get('node_errors')}")
+    except Exception as e:
+        logger.error(f"Error queuing prompt on {server_address}: {e}")
+        result = {}
+    if result.get("prompt_id"):
+        ledger.record(request_id, result["prompt_id"])
+    else:
+        ledger.release(request_id)
+    return result
+
+async def get_image(filename, subfolder, folder_type, server_address=SERVER_ADDRESS):
+    params = {"filename": filename, "type": folder_type}
+    if subfolder:
+        params["subfolder"] = subfolder
+    try:
+        async with get_session().get(f"http://{server_address}/view", params=params) as response:
+            response.raise_for_status()
+            return await response.read()
+    except Exception as e:
+        logger.error(f"Error retrieving image: {e}")
+        return None
+
+async def has_input(name, server_address=SERVER_ADDRESS):
+    # HEAD on /view answers from the backend's input folder without transferring the file
+    async with get_session().head(f"http://{server_address}/view", params={"filename": name, "type": "input"}) as response:
+        return response.status == 200
+
+async def upload_input(name, server_address=SERVER_ADDRESS):
+    # aiohttp streams the open file in chunks, reading it in the default executor
+    with open(input_dir() / name, "rb") as f:
+        form = aiohttp.FormData()
+        form.add_field("image", f, filename=name, content_type="application/octet-stream")
+        form.add_field("type", "input")
+        form.add_field("overwrite", "true")
+        async with get_session().post(f"http://{server_address}/upload/image", data=form) as response:
+            response.raise_for_status()
+            result = await response.json()
+    if result.get("name") != name:
+        raise RuntimeError(f"ComfyUI stored input {name} as {result.get('name')}")
+
+async def ensure_inputs(prompt, backend):
+    """
+    Copies every stored input the prompt loads to the backend, unless it is the ComfyUI on this
+    host reading them from its own input folder (the "local" transport); with the "upload"
+    transport, or for any other backend, they go over HTTP. Names are content hashes, so a name
+    the backend already has is skipped without a transfer.
+    """
+    if INPUT_TRANSPORT != "upload" and backend.address == SERVER_ADDRESS:
+        return
+
+    async def ensure(name):
+        if not await has_input(name, backend.address):
+            await upload_input(name, backend.address)
+            logger.info(f"Uploaded input {name} to {backend.address}")
+        backend.inputs.put(name, True)
+
+    missing = [name for name in prompt_inputs(prompt) if backend.inputs.get(name) is None]
+    await asyncio.gather(*(ensure(name) for name in missing))
+
+async def get_history(prompt_id, server_address=SERVER_ADDRESS):
+    try:
+        async with get_session().get(f"http://{server_address}/history/{prompt_id}") as response:
+            response.raise_for_status()
+            return await response.json()
+    except Exception as e:
+        logger.error(f"Error retrieving history: {e}")
+        return {}
+
+async def get_queue(server_address=SERVER_ADDRESS):
+    try:
+        async with get_session().get(f"http://{server_address}/queue") as response:
+            response.raise_for_status()
+            return await response.json()
+    except Exception as e:
+        logger.error(f"Error retrieving queue: {e}")
+        return {}
+
+async def get_queue_position(prompt_id):
+    """1-based place of the prompt among its backend's pending prompts, 0 once it runs, else None."""
+    backend = get_pool().backend_for(prompt_id)
+    if backend is None:
+        return None
+    queue = await get_queue(backend.address)
+    if any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+        return 0
+    pending = sorted(queue.get("queue_pending", []), key=lambda item: item[0])
+    for position, item in enumerate(pending, start=1):
+        if item[1] == prompt_id:
+            return position
+    return None
+
+async def cancel_prompt(prompt_id):
+    # Pending prompts are removed from the queue; a running one is interrupted
+    backend = get_pool().backend_for(prompt_id)
+    if backend is None:
+        return
+    server_address = backend.address
+    queue = await get_queue(server_address)
+    running = {item[1] for item in queue.get("queue_running", [])}
+    try:
+        if prompt_id in running:
+            async with get_session().post(f"http://{server_address}/interrupt", json={"prompt_id": prompt_id}) as response:
+                response.raise_for_status()
+        else:
+            async with get_session().post(f"http://{server_address}/queue", json={"delete": [prompt_id]}) as response:
+                response.raise_for_status()
+    except Exception as e:
+        logger.error(f"Error cancelling prompt {prompt_id}: {e}")
+
+# ComfyUI's BinaryEventTypes.PREVIEW_IMAGE, also used by SaveImageWebsocket
+PREVIEW_IMAGE = 1
+
+# Events that carry a prompt_id and are routed to the coroutine waiting on that prompt
+PROMPT_EVENTS = {"execution_start", "execution_cached", "executing", "progress", "executed",
+                 "execution_success", "execution_error", "execution_interrupted"}
+
+class PromptWatch:
+    """Waiting state for one queued prompt: a completion future plus optional event listeners."""
+
+    def __init__(self, prompt_id):
+        self.prompt_id = prompt_id
+        self.done = asyncio.get_running_loop().create_future()
+        self.listeners = []
+        # Nodes whose binary frames are output images (SaveImageWebsocket), and those images
+        self.output_nodes = set()
+        self.images = []
+
+    def deliver_binary(self, node, data):
+        # Binary frames are a 4-byte event type, a 4-byte image format and the encoded image
+        if len(data) <= 8 or struct.unpack(">I", data[:4])[0] != PREVIEW_IMAGE:
+            return
+        if node in self.output_nodes:
+            self.images.append((node, data[8:]))
+            return
+        # Anything else is a sampler's latent preview; listeners get it as a "preview" event
+        image_format = "png" if struct.unpack(">I", data[4:8])[0] == 2 else "jpeg"
+        message = {"type": "preview", "data": {"prompt_id": self.prompt_id, "node": node, "format": image_format, "image": data[8:]}}
+        for listener in self.listeners:
+            try:
+                listener(message)
+            except Exception as e:
+                logger.error(f"Prompt listener failed for {self.prompt_id}: {e}")
+
+    def deliver(self, message):
+        for listener in self.listeners:
+            try:
+                listener(message)
+            except Exception as e:
+                logger.error(f"Prompt listener failed for {self.prompt_id}: {e}")
+
+        event, data = message["type"], message["data"]
+        if self.done.done():
+            return
+        if event == "execution_error":
+            self.done.set_exception(RuntimeError(f"ComfyUI execution failed on node {data.get('node_id')}: {data.get('exception_message')}"))
+        elif event == "execution_interrupted":
+            self.done.set_exception(RuntimeError("ComfyUI execution was interrupted."))
+        elif event == "executing" and data.get("node") is None:
+            self.done.set_result(None)
+
+    async def wait(self):
+        await self.done
+
+class PromptEventDispatcher:
+    """
+    One long-lived WebSocket to a ComfyUI server, shared by every request in the process.
+
+    Messages are routed by prompt_id to the matching PromptWatch with a single dict lookup,
+    so hundreds of open prompts cost nothing beyond their entry. The connection reconnects
+    with backoff, and prompts that finished while it was down are resolved from /history.
+    If it stays down for DISPATCHER_RECONNECT_ATTEMPTS attempts, or the pool ejects the
+    backend meanwhile, the prompts still waiting on it fail instead of waiting forever.
+    """
+
+    RECENT_LIMIT = 1024
+    EARLY_FRAME_LIMIT = 64
+
+    def __init__(self, server_address, client_id):
+        self.server_address = server_address
+        self.client_id = client_id
+        self.watches = {}
+        # Terminal messages for prompts that finished before anybody called watch()
+        self.recent = OrderedDict()
+        # Binary frames carry no prompt_id; they belong to the node ComfyUI last reported executing
+        self.executing = None
+        self.early_frames = OrderedDict()
+        self.connected = asyncio.Event()
+        # Why waiting prompts were failed while disconnected; prompts watched before the next connect fail too
+        self.lost = None
+        self.task = None
+        self.resync_task = None
+
+    async def start(self, timeout=10):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        if not timeout:
+            return
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"WebSocket to {self.server_address} not connected yet, continuing to retry")
+
+    async def stop(self):
+        for task in (self.task, self.resync_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.task = None
+        self.resync_task = None
+        for watch in self.watches.values():
+            if not watch.done.done():
+                watch.done.set_exception(RuntimeError("ComfyUI event listener stopped."))
+        self.watches.clear()
+
+    def watch(self, prompt_id, output_nodes=()):
+        watch = self.watches.get(prompt_id)
+        if watch is None:
+            watch = self.watches[prompt_id] = PromptWatch(prompt_id)
+            watch.output_nodes.update(output_nodes)
+            if self.lost is not None:
+                watch.done.set_exception(RuntimeError(self.lost))
+            for node, data in self.early_frames.pop(prompt_id, []):
+                watch.deliver_binary(node, data)
+            finished = self.recent.pop(prompt_id, None)
+            if finished is not None:
+                watch.deliver(finished)
+        return watch
+
+    def release(self, prompt_id):
+        self.watches.pop(prompt_id, None)
+
+    def fail_watches(self, reason):
+        # No event or /history answer will come for these; fail them so their requests can return
+        self.lost = reason
+        for watch in self.watches.values():
+            if not watch.done.done():
+                watch.done.set_exception(RuntimeError(reason))
+
+    def dispatch(self, message):
+        if message.get("type") not in PROMPT_EVENTS:
+            return
+        prompt_id = message["data"].get("prompt_id")
+        if message["type"] == "executing":
+            node = message["data"].get("node")
+            self.executing = (prompt_id, node) if node is not None else None
+        watch = self.watches.get(prompt_id)
+        if watch is not None:
+            watch.deliver(message)
+        elif message["type"] in ("execution_error", "execution_interrupted") or (
+                message["type"] == "executing" and message["data"].get("node") is None):
+            self.recent[prompt_id] = message
+            if len(self.recent) > self.RECENT_LIMIT:
+                self.recent.popitem(last=False)
+
+    def dispatch_binary(self, data):
+        if self.executing is None:
+            return
+        prompt_id, node = self.executing
+        watch = self.watches.get(prompt_id)
+        if watch is not None:
+            watch.deliver_binary(node, data)
+        else:
+            # A fast prompt can send its images before the submitter has called watch()
+            frames = self.early_frames.setdefault(prompt_id, [])
+            if len(frames) < self.EARLY_FRAME_LIMIT:
+                frames.append((node, data))
+            while len(self.early_frames) > self.RECENT_LIMIT:
+                self.early_frames.popitem(last=False)
+
+    async def resync(self):
+        # Resolve prompts whose completion message was lost while we were disconnected
+        queue = await get_queue(self.server_address)
+        queued = {item[1] for key in ("queue_running", "queue_pending") for item in queue.get(key, [])}
+        for prompt_id, watch in list(self.watches.items()):
+            if watch.done.done():
+                continue
+            history = (await get_history(prompt_id, self.server_address)).get(prompt_id)
+            if not history:
+                if queue and prompt_id not in queued:
+                    # The server restarted and forgot the prompt, so no event will ever come
+                    watch.done.set_exception(RuntimeError(f"Prompt {prompt_id} was lost by {self.server_address}."))
+                continue
+            if history.get("status", {}).get("status_str") == "error":
+                watch.deliver({"type": "execution_error", "data": {"prompt_id": prompt_id, "exception_message": "reported by /history"}})
+            else:
+                watch.deliver({"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+
+    async def _run(self):
+        backoff = 0.5
+        # Disconnects and failed reconnects since the socket was last up
+        failures = 0
+        url = f"ws://{self.server_address}/ws?clientId={self.client_id}"
+        while True:
+            try:
+                async with get_session().ws_connect(url, heartbeat=30) as ws:
+                    self.connected.set()
+                    self.lost = None
+                    backoff = 0.5
+                    failures = 0
+                    self.resync_task = asyncio.create_task(self.resync())
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self.dispatch(json.loads(msg.data))
+                        elif msg.type == aiohttp.WSMsgType.BINARY:
+                            self.dispatch_binary(msg.data)
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"WebSocket error for {self.server_address}: {e}")
+            self.connected.clear()
+            failures += 1
+            if failures == DISPATCHER_RECONNECT_ATTEMPTS:
+                if self.watches:
+                    logger.error(f"WebSocket to {self.server_address} still down, failing {len(self.watches)} waiting prompt(s)")
+                self.fail_watches(f"Lost the connection to ComfyUI at {self.server_address}.")
+            logger.warning(f"WebSocket to {self.server_address} closed, reconnecting in {backoff}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+_pool = None
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = BackendPool(COMFY_BACKENDS, get_session, lambda address: PromptEventDispatcher(address, client_id))
+    return _pool
+
+async def start_event_listener():
+    await get_pool().start()
+
+async def stop_event_listener():
+    global _pool
+    if _pool is not None:
+        await _pool.stop()
+    _pool = None
+
+async def wait_for_prompt(prompt_id, dispatcher, listener=None, output_nodes=()):
+    """Waits for the prompt to finish; returns the (node, image) pairs its `output_nodes` sent over the socket."""
+    watch = dispatcher.watch(prompt_id, output_nodes)
+    if listener is not None:
+        watch.listeners.append(listener)
+    try:
+        await watch.wait()
+    finally:
+        dispatcher.release(prompt_id)
+    return watch.images
+
+async def submit_prompt(prompt, request_id):
+    """Queues the prompt on the least loaded healthy backend, failing over on connection errors."""
+    pool = get_pool()
+    if pool.task is None:
+        await pool.start()
+    tried = []
+    while True:
+        backend = pool.acquire(exclude=tried)
+        if backend is None:
+            raise RuntimeError("No healthy ComfyUI backend available.")
+        tried.append(backend)
+        try:
+            await ensure_inputs(prompt, backend)
+        except Exception as e:
+            pool.release(backend)
+            pool.report_failure(backend, f"input upload failed: {e}")
+            continue
+        await backend.dispatcher.start()
+        result = await queue_prompt(prompt, request_id, backend.address)
+        if result.get("prompt_id"):
+            pool.assign(result["prompt_id"], backend)
+            return result["prompt_id"], backend
+        pool.release(backend)
+        if result:
+            # The backend answered but refused the graph
+            return None, backend
+        pool.report_failure(backend, "prompt submission failed")
+
+async def get_outputs(prompt, request_id, listener=None):
+    """
+    Runs the prompt and returns (prompt_id, backend, [history entries of its output images],
+    [image bytes received over the WebSocket]). Either list is in the order of the output nodes
+    in `prompt`, whatever order ComfyUI ran them in.
+    """
+    websocket_nodes = [node_id for node_id, node in prompt.items() if node.get("class_type") == WEBSOCKET_SAVE_NODE]
+    prompt_id, backend = await submit_prompt(prompt, request_id)
+    if not prompt_id:
+        return None, backend, [], []
+    try:
+        received = await wait_for_prompt(prompt_id, backend.dispatcher, listener, websocket_nodes)
+    finally:
+        get_pool().complete(prompt_id)
+    if websocket_nodes:
+        # Every save node streamed its images; there is nothing to look up in /history
+        if not received:
+            logger.warning(f"Prompt {prompt_id} finished without sending any images over the WebSocket")
+        position = {node_id: index for index, node_id in enumerate(websocket_nodes)}
+        return prompt_id, backend, [], [image for _, image in sorted(received, key=lambda frame: position[frame[0]])]
+
+    # Outputs only exist on the backend that ran the prompt
+    history = (await get_history(prompt_id, backend.address)).get(prompt_id, {})
+    position = {node_id: index for index, node_id in enumerate(prompt)}
+    outputs = sorted(history.get("outputs", {}).items(), key=lambda output: position.get(output[0], len(position)))
+    files = [
+        image
+        for _, node_output in outputs
+        for image in node_output.get("images", [])
+    ]
+    return prompt_id, backend, files, []
+
+async def fetch_outputs(files, backend):
+    # All outputs at once over the shared keep-alive session rather than one after another;
+    # None for any that could not be downloaded
+    data = await asyncio.gather(*(
+        get_image(image.get("filename"), image.get("subfolder"), image.get("type"), backend.address)
+        for image in files
+    ))
+    return [image_data or None for image_data in data]
+
+async def get_prompt_images(prompt, request_id, listener=None, workflow=None, keep_slots=False):
+    """
+    Async counterpart of websockets_api.get_prompt_images for the FastAPI handlers.
+
+    Queues the prompt and waits for it without blocking the event loop. With
+    OUTPUT_TRANSPORT "websocket" the images arrive on the shared socket; otherwise outputs
+    of the ComfyUI on this host ("local") are linked from its output folder and other
+    backends' outputs are downloaded in parallel. They are stored in a worker thread
+    in the format OUTPUT_FORMATS sets for `workflow`. Returns the inserted generated_images
+    rows, in the order of the prompt's output nodes; with `keep_slots` there is one entry per
+    output image ComfyUI reported, None where it could not be fetched or stored. `listener`,
+    if given, is called with every WebSocket event for the prompt.
+    """
+    prompt_id, backend, files, sources = await get_outputs(prompt, request_id, listener)
+    if not prompt_id:
+        raise RuntimeError("ComfyUI did not accept the prompt.")
+
+    local = [None] * len(files)
+    if OUTPUT_TRANSPORT == "local" and backend.address == SERVER_ADDRESS:
+        local = [path if path.is_file() else None for path in map(local_output_path, files)]
+        if None in local:
+            logger.warning(f"{local.count(None)} output(s) of prompt {prompt_id} not found under {COMFY_UI_PATH}, downloading them")
+    # Downloads go back into the slots of the outputs they replace, so the order stays that of the graph
+    downloaded = iter(await fetch_outputs([image for image, path in zip(files, local) if path is None], backend))
+    sources += [path if path is not None else next(downloaded) for path in local]
+    return await asyncio.to_thread(save_images_to_db, client_id, prompt_id, sources, workflow, keep_slots)
@@ -0,0 +1,151 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+import aiohttp
+from lru import LRUCache
+from settings import BACKEND_HEALTH_INTERVAL, BACKEND_FAILURE_THRESHOLD, BACKEND_HEALTH_TIMEOUT, UPLOADED_INPUTS_PER_BACKEND
+
+logger = logging.getLogger(__name__)
+
+class Backend:
+    """One ComfyUI server in the pool, with its last observed health and load."""
+
+    def __init__(self, address, dispatcher):
+        self.address = address
+        self.dispatcher = dispatcher
+        self.healthy = True
+        self.failures = 0
+        self.queue_depth = 0
+        self.vram_free = 0
+        # Prompts this process submitted here that have not finished yet
+        self.assigned = 0
+        self.last_checked = None
+        # Stored input names known to be in this backend's input folder (upload transport)
+        self.inputs = LRUCache(UPLOADED_INPUTS_PER_BACKEND)
+
+    @property
+    def load(self):
+        # /queue is only refreshed every few seconds, so also count what we sent since then
+        return max(self.queue_depth, self.assigned)
+
+    def to_dict(self):
+        return {
+            "address": self.address,
+            "healthy": self.healthy,
+            "failures": self.failures,
+            "queue_depth": self.queue_depth,
+            "assigned": self.assigned,
+            "vram_free": self.vram_free,
+            "connected": self.dispatcher.connected.is_set(),
+            "last_checked": self.last_checked,
+        }
+
+class BackendPool:
+    """
+    Routes prompts across several ComfyUI servers by live queue depth.
+
+    A background loop polls each backend's /queue and /system_stats. A backend is ejected
+    after BACKEND_FAILURE_THRESHOLD failed checks or submissions in a row and re-added on
+    its next good check; if its event socket is down by then, prompts waiting on it fail. The pool also remembers which backend ran each prompt so that
+    history and outputs are fetched from the right place.
+    """
+
+    PROMPT_MAP_LIMIT = 10000
+
+    def __init__(self, addresses, session_factory, dispatcher_factory):
+        self.session_factory = session_factory
+        self.backends = [Backend(address, dispatcher_factory(address)) for address in addresses]
+        self.prompt_backends = OrderedDict()
+        self.task = None
+
+    async def start(self):
+        await asyncio.gather(*(self.check(backend) for backend in self.backends))
+        # Backends that failed their first check keep reconnecting in the background
+        await asyncio.gather(*(backend.dispatcher.start(timeout=10 if backend.failures == 0 else 0) for backend in self.backends))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.task = None
+        await asyncio.gather(*(backend.dispatcher.stop() for backend in self.backends))
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(BACKEND_HEALTH_INTERVAL)
+            await asyncio.gather(*(self.check(backend) for backend in self.backends))
+
+    async def check(self, backend):
+        timeout = aiohttp.ClientTimeout(total=BACKEND_HEALTH_TIMEOUT)
+        session = self.session_factory()
+        try:
+            async with session.get(f"http://{backend.address}/queue", timeout=timeout) as response:
+                response.raise_for_status()
+                queue = await response.json()
+            async with session.get(f"http://{backend.address}/system_stats", timeout=timeout) as response:
+                response.raise_for_status()
+                stats = await response.json()
+        except Exception as e:
+            self.report_failure(backend, f"health check failed: {e}")
+            return
+
+        backend.queue_depth = len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+        devices = stats.get("devices") or [{}]
+        backend.vram_free = devices[0].get("vram_free", 0)
+        backend.last_checked = time.time()
+        backend.failures = 0
+        if not backend.healthy:
+            logger.info(f"ComfyUI backend {backend.address} recovered, adding it back to the pool")
+            backend.healthy = True
+            await backend.dispatcher.start(timeout=0)
+
+    def report_failure(self, backend, reason):
+        backend.failures += 1
+        if backend.healthy:
+            logger.warning(f"ComfyUI backend {backend.address}: {reason}")
+        if backend.healthy and backend.failures >= BACKEND_FAILURE_THRESHOLD:
+            logger.error(f"Ejecting ComfyUI backend {backend.address} after {backend.failures} failures")
+            backend.healthy = False
+            if not backend.dispatcher.connected.is_set():
+                # Its socket is down too, so prompts running there would never hear back
+                backend.dispatcher.fail_watches(f"ComfyUI backend {backend.address} was ejected from the pool.")
+
+    def acquire(self, exclude=()):
+        """
+        Picks the least loaded healthy backend (free VRAM breaks ties) and reserves a slot on it
+        before returning, so a burst of concurrent submissions spreads out instead of all
+        choosing the same backend. Returns None when no healthy backend is left.
+        """
+        healthy = [backend for backend in self.backends if backend.healthy and backend not in exclude]
+        if not healthy:
+            return None
+        backend = min(healthy, key=lambda backend: (backend.load, -backend.vram_free))
+        backend.assigned += 1
+        return backend
+
+    def release(self, backend):
+        # Give back a reservation whose submission did not reach the queue
+        if backend.assigned > 0:
+            backend.assigned -= 1
+
+    def assign(self, prompt_id, backend):
+        self.prompt_backends[prompt_id] = backend
+        while len(self.prompt_backends) > self.PROMPT_MAP_LIMIT:
+            self.prompt_backends.popitem(last=False)
+
+    def complete(self, prompt_id):
+        backend = self.prompt_backends.get(prompt_id)
+        if backend is not None:
+            self.release(backend)
+
+    def backend_for(self, prompt_id):
+        return self.prompt_backends.get(prompt_id)
+
+    def stats(self):
+        return [backend.to_dict() for backend in self.backends]
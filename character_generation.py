@@ -1,82 +1,55 @@
-import json
-import random
 import uuid
-from datetime import datetime
+import random
 from pathlib import Path
-import os
 import gradio as gr
-from PIL import Image
-import numpy as np
 
-from websockets_api import get_prompt_images
-from settings import COMFY_UI_PATH, FLUX_CHARACTER_FACE_WORKFLOW
+from websockets_api import get_prompt_images, progress_listener
+from settings import COMFY_UI_PATH
+from input_store import store_input_image
+from workflow_templates import render_workflow
 from template_prompt import character_generation_prompt
 
 
-def ensure_directory_exists(directory: Path):
-    """ Ensure the directory exists and has write permissions. """
-    try:
-        directory.mkdir(parents=True, exist_ok=True)
-        if not os.access(directory, os.W_OK):
-            raise PermissionError(f"Write permission denied for directory: {directory}")
-    except Exception as e:
-        print(f"Error ensuring directory exists: {e}")
-        raise
-
-
 def save_input_image(image, image_bg):
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())
-
-    input_dir = Path(COMFY_UI_PATH) / "input"
-    ensure_directory_exists(input_dir)
-
-    input_image = input_dir / f"img_{timestamp}_{unique_id}.jpg"
-    input_image_bg = input_dir / f"img_bg_{timestamp}_{unique_id}.jpg"
-
     try:
-        pillow_image = Image.fromarray(image.astype(np.uint8)) if isinstance(image, np.ndarray) else image
-        pillow_image_bg = Image.fromarray(image_bg.astype(np.uint8)) if isinstance(image_bg, np.ndarray) else image_bg
-
-        pillow_image.save(input_image)
-        pillow_image_bg.save(input_image_bg)
-
-        return input_image.name, input_image_bg.name
+        return store_input_image(image), store_input_image(image_bg)
     except PermissionError:
-        print(f"Permission denied while saving images to {input_dir}. Try running as administrator.")
+        print(f"Permission denied while saving images to {Path(COMFY_UI_PATH) / 'input'}. Try running as administrator.")
         return None, None
     except Exception as e:
         print(f"Error saving images: {e}")
         return None, None
 
 
-def process(img, img_bg, person_prompt, style_choice, custom_style):
+def process(img, img_bg, person_prompt, style_choice, custom_style, progress=gr.Progress()):
+    request_id = str(uuid.uuid4())
     try:
-        with open(FLUX_CHARACTER_FACE_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
-
-        # Set a random seed for reproducibility
-        prompt["25"]["inputs"]["noise_seed"] = random.randint(0, 99999999999999999)
-
         # Default Person Description
         default_person_prompt = "A man in middle, full body, clean-shaven, medium side-swept hairstyle"
-        prompt["113"]["inputs"]["text"] = person_prompt.strip() if person_prompt and person_prompt.strip() else default_person_prompt
+        person_text = person_prompt.strip() if person_prompt and person_prompt.strip() else default_person_prompt
 
         # Style Selection Logic
         if style_choice == "No":
-            prompt["79"]["inputs"]["text"] = custom_style.strip() if custom_style.strip() else "Custom style not provided"
+            style_text = custom_style.strip() if custom_style.strip() else "Custom style not provided"
         else:
-            prompt["79"]["inputs"]["text"] = character_generation_prompt[int(style_choice)]  # Direct dictionary lookup
+            style_text = character_generation_prompt[int(style_choice)]  # Direct dictionary lookup
 
         # Save images and update paths
         img_filename, img_bg_filename = save_input_image(img, img_bg)
         if not img_filename or not img_bg_filename:
             return "Error: Unable to save images. Check permissions."
 
-        prompt["42"]["inputs"]["image"] = str(img_filename)
-        prompt["85"]["inputs"]["background_image"] = str(img_bg_filename)
-
-        images = get_prompt_images(prompt)
+        prompt = render_workflow("character-generation", {
+            # Set a random seed for reproducibility
+            "25": {"noise_seed": random.randint(0, 99999999999999999)},
+            "113": {"text": person_text},
+            "79": {"text": style_text},
+            "42": {"image": str(img_filename)},
+            # Node 85 is a LoadImage, so the background goes into its "image" input
+            "85": {"image": str(img_bg_filename)},
+        })
+
+        images = get_prompt_images(prompt, request_id, listener=progress_listener(progress), workflow="character-generation")
         return images if images else "No images generated."
 
     except Exception as e:
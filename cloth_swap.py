@@ -1,30 +1,13 @@
-import json
-import random
 import uuid
-from datetime import datetime
-from pathlib import Path
+import random
 import gradio as gr
-from PIL import Image
-from websockets_api import get_prompt_images
-from settings import COMFY_UI_PATH, CLOTH_SWAP_WORKFLOW
+from websockets_api import get_prompt_images, progress_listener
+from input_store import store_input_image
+from workflow_templates import render_workflow
 
-# Save input image and reference image into the input folder inside ComfyUI with unique filenames
+# Save input image and reference image into the input folder inside ComfyUI, named after their content
 def save_input_image(img, img_ref):
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())
-    
-    input_dir = Path(COMFY_UI_PATH) / "input"
-    input_dir.mkdir(parents=True, exist_ok=True) 
-
-    input_img = input_dir / f"img_{timestamp}_{unique_id}.jpg"
-    input_img_ref = input_dir / f"img_ref_{timestamp}_{unique_id}.jpg"
-
-    pillow_image = Image.fromarray(img)
-    pillow_image_ref = Image.fromarray(img_ref)
-    pillow_image.save(str(input_img)) 
-    pillow_image_ref.save(str(input_img_ref))  
-    
-    return input_img.name, input_img_ref.name 
+    return store_input_image(img), store_input_image(img_ref)
 
 # Save output images into the output folder inside ComfyUI with unique filenames
 # def save_output_images(images):
@@ -46,32 +29,31 @@ def save_input_image(img, img_ref):
 
 #     return output_filenames
 
-def process(img, img_ref, top_clothes, bottom_clothes, torso, left_Arm, right_Arm, left_leg, rigth_leg):
-    with open(CLOTH_SWAP_WORKFLOW, "r", encoding="utf-8") as f:
-        prompt = json.load(f)
-
-    # Set a random seed for reproducibility
-    prompt["1"]["inputs"]["seed"] = random.randint(0, 999999999999999)
-
-    # Map the top_clothes and bottom_clothes inputs
-    prompt["13"]["inputs"].update({
-        "top_clothes" : top_clothes == "True",
-        "bottom_clothes": bottom_clothes == "True",
-        "torso_skin": torso == "True",
-        "left_arm": left_Arm == "True",
-        "right_arm": right_Arm == "True",
-        "left_leg": left_leg == "True",
-        "right_leg": rigth_leg == "True"
-    })
+def process(img, img_ref, top_clothes, bottom_clothes, torso, left_Arm, right_Arm, left_leg, rigth_leg, progress=gr.Progress()):
+    request_id = str(uuid.uuid4())
     img_filename, img_ref_filename = save_input_image(img, img_ref)
 
-    # Map the input images into the workflow
-    prompt["17"]["inputs"]["image"] = img_filename
-    prompt["18"]["inputs"]["image"] = img_ref_filename
+    prompt = render_workflow("cloth-swap", {
+        # Set a random seed for reproducibility
+        "1": {"seed": random.randint(0, 999999999999999)},
+        # Map the top_clothes and bottom_clothes inputs
+        "13": {
+            "top_clothes" : top_clothes == "True",
+            "bottom_clothes": bottom_clothes == "True",
+            "torso_skin": torso == "True",
+            "left_arm": left_Arm == "True",
+            "right_arm": right_Arm == "True",
+            "left_leg": left_leg == "True",
+            "right_leg": rigth_leg == "True"
+        },
+        # Map the input images into the workflow
+        "17": {"image": img_filename},
+        "18": {"image": img_ref_filename},
+    })
 
     # print(f"Updated prompt: {json.dumps(prompt, indent=2)}")
     
-    images = get_prompt_images(prompt)
+    images = get_prompt_images(prompt, request_id, listener=progress_listener(progress), workflow="cloth-swap")
     # Save output images to disk
     # save_output_images(images)
     
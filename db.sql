@@ -5,5 +5,12 @@ CREATE TABLE generated_images (
     image_output_path TEXT NOT NULL,
     file_size BIGINT,
     file_type TEXT,
-    upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
\ No newline at end of file
+    upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    workflow TEXT
+);
+
+-- GET /images pages newest first on (upload_time, id); one index per filter keeps every page an index range scan
+CREATE INDEX generated_images_upload_time_idx ON generated_images (upload_time, id);
+CREATE INDEX generated_images_client_id_idx ON generated_images (client_id, upload_time, id);
+CREATE INDEX generated_images_prompt_id_idx ON generated_images (prompt_id, upload_time, id);
+CREATE INDEX generated_images_workflow_idx ON generated_images (workflow, upload_time, id);
@@ -0,0 +1,146 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from db_config import DB_CONFIG
+from settings import DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_HEALTH_CHECK_IDLE
+
+logger = logging.getLogger(__name__)
+
+class PoolTimeout(psycopg2.OperationalError):
+    """No connection became free within DB_POOL_TIMEOUT seconds."""
+
+class DatabasePool:
+    """
+    Bounded, thread-safe pool of psycopg2 connections.
+
+    ThreadedConnectionPool fails immediately when it is exhausted, so a semaphore in front
+    of it makes callers wait (up to DB_POOL_TIMEOUT) for a free connection instead.
+    Connections idle for longer than DB_POOL_HEALTH_CHECK_IDLE are pinged before use and
+    replaced if the server dropped them.
+    """
+
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **DB_CONFIG)
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.last_used = {}
+        self.checkouts = 0
+        self.in_use = 0
+        self.timeouts = 0
+        self.replaced = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self.last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < DB_POOL_HEALTH_CHECK_IDLE:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        conn = self.pool.getconn()
+        if not self._healthy(conn):
+            logger.warning("Replacing a broken database connection")
+            self.last_used.pop(id(conn), None)
+            self.pool.putconn(conn, close=True)
+            with self.lock:
+                self.replaced += 1
+            conn = self.pool.getconn()
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of the block. Like `with psycopg2.connect()`,
+        the transaction is committed when the block succeeds and rolled back when it raises.
+        """
+        start = time.monotonic()
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.timeouts += 1
+            raise PoolTimeout(f"No database connection free after {self.timeout}s")
+        waited = time.monotonic() - start
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        conn = None
+        broken = False
+        try:
+            conn = self._checkout()
+            yield conn
+            conn.commit()
+        except BaseException:
+            if conn is not None:
+                broken = bool(conn.closed)
+                if not broken:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        broken = True
+            raise
+        finally:
+            if conn is not None:
+                if broken:
+                    self.last_used.pop(id(conn), None)
+                else:
+                    self.last_used[id(conn)] = time.monotonic()
+                self.pool.putconn(conn, close=broken)
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    def close(self):
+        self.pool.closeall()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "in_use": self.in_use,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "replaced": self.replaced,
+                "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def init_db_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = DatabasePool()
+    return _db_pool
+
+def get_db_pool():
+    # Created at API startup; the Gradio apps get theirs on first use
+    return _db_pool or init_db_pool()
+
+def close_db_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.close()
+        _db_pool = None
+
+def db_connection():
+    return get_db_pool().connection()
@@ -0,0 +1,166 @@
+import io
+import os
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from input_store import write_atomic
+from output_store import ENCODINGS
+from result_storage import get_result_storage
+from settings import (DERIVATIVES_PATH, DERIVATIVE_CACHE_BYTES, DERIVATIVE_WORKERS, DERIVATIVE_QUALITY,
+                      EAGER_THUMBNAIL_WIDTHS, DERIVATIVE_FORMAT)
+
+logger = logging.getLogger(__name__)
+
+# Resizing and encoding release the GIL, like the result encoders in output_store
+_executor = ThreadPoolExecutor(max_workers=DERIVATIVE_WORKERS, thread_name_prefix="derivative")
+
+class DiskLRU:
+    """
+    Size-bounded LRU over the files of one directory. The index is rebuilt from modification
+    times on first use; files another process added are adopted when they are first looked up.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = None
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.entries = OrderedDict()
+        files = [
+            (path.stat(), path.name)
+            for path in self.directory.iterdir()
+            if path.is_file() and not path.name.startswith(".")
+        ]
+        for stat, name in sorted(files, key=lambda item: item[0].st_mtime):
+            self.entries[name] = stat.st_size
+            self.total_bytes += stat.st_size
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            (self.directory / name).unlink(missing_ok=True)
+
+    def _add(self, name, size):
+        self.total_bytes += size - self.entries.pop(name, 0)
+        self.entries[name] = size
+        self._evict()
+
+    def get(self, name):
+        with self.lock:
+            self._load()
+            path = self.directory / name
+            if name in self.entries:
+                self.entries.move_to_end(name)
+            elif path.exists():
+                self._add(name, path.stat().st_size)
+            else:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return path
+
+    def put(self, name, data):
+        path = self.directory / name
+        with self.lock:
+            self._load()
+        write_atomic(path, data)
+        with self.lock:
+            self._add(name, len(data))
+        return path
+
+    def stats(self):
+        with self.lock:
+            self._load()
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            }
+
+derivative_cache = DiskLRU(DERIVATIVES_PATH, DERIVATIVE_CACHE_BYTES)
+
+def derivative_name(name, width, fmt):
+    return f"{os.path.splitext(name)[0]}_w{width}{ENCODINGS[fmt][1]}"
+
+def render_derivative(source: Path, width, fmt) -> bytes:
+    """Decodes `source` once and encodes a copy at most `width` pixels wide (never upscaled)."""
+    pil_format, _, _, defaults = ENCODINGS[fmt]
+    with Image.open(source) as image:
+        if image.format == "JPEG":
+            image.draft(image.mode, (width, image.height * width // image.width + 1))
+        image.thumbnail((width, image.height), Image.LANCZOS)
+        if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        options = {**defaults, **({"quality": DERIVATIVE_QUALITY} if "quality" in defaults else {})}
+        image.save(buffer, format=pil_format, **options)
+    return buffer.getvalue()
+
+def ensure_derivative(name, width, fmt, source: Path = None) -> Path:
+    """
+    Path of the cached derivative of result `name`, rendering it first if needed, from `source`
+    or else from a local copy out of the result storage. Blocking.
+    """
+    cached_name = derivative_name(name, width, fmt)
+    path = derivative_cache.get(cached_name)
+    if path is None:
+        if source is not None:
+            data = render_derivative(source, width, fmt)
+        else:
+            with get_result_storage().local_copy(name) as source:
+                data = render_derivative(source, width, fmt)
+        path = derivative_cache.put(cached_name, data)
+    return path
+
+# Derivatives being rendered, so concurrent requests for the same tile share one render
+_rendering = {}
+
+async def get_derivative(name, width, fmt) -> Path:
+    cached_name = derivative_name(name, width, fmt)
+    future = _rendering.get(cached_name)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(_executor, ensure_derivative, name, width, fmt)
+        _rendering[cached_name] = future
+        future.add_done_callback(lambda _: _rendering.pop(cached_name, None))
+    return await asyncio.shield(future)
+
+def _render_thumbnails(path, after):
+    for width in EAGER_THUMBNAIL_WIDTHS:
+        try:
+            ensure_derivative(path.name, width, DERIVATIVE_FORMAT, source=path)
+        except Exception as e:
+            logger.error(f"Error rendering {width}px thumbnail of {path}: {e}")
+    if after is not None:
+        after(path)
+
+def schedule_thumbnails(paths, after=None):
+    """
+    Renders EAGER_THUMBNAIL_WIDTHS for freshly saved results in the background from their local
+    files, then calls after(path) (the storage releasing its local copy).
+    """
+    for path in paths:
+        if EAGER_THUMBNAIL_WIDTHS:
+            _executor.submit(_render_thumbnails, Path(path), after)
+        elif after is not None:
+            after(Path(path))
@@ -1,37 +1,21 @@
-import json
 import uuid
-from datetime import datetime
-from pathlib import Path
 import gradio as gr
-from PIL import Image
-from websockets_api import get_prompt_images
-from settings import COMFY_UI_PATH, EXPRESSION_WORKFLOW
+from websockets_api import get_prompt_images, progress_listener
+from input_store import store_input_image
+from workflow_templates import render_workflow
 
-# Save input image and reference image into the input folder inside ComfyUI with unique filenames
+# Save the input image into the input folder inside ComfyUI, named after its content
 def save_input_image(img):
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())
-    input_img = Path(COMFY_UI_PATH) / f"input/img_{timestamp}_{unique_id}.jpg"
-
-    pillow_image = Image.fromarray(img)
-    pillow_image.save(input_img)
-
-    return input_img.name
+    return store_input_image(img)
 
 # Main processing function
-def process(img, rotate_pitch, rotate_yaw, rotate_roll, blink, eyebrow, wink, pupil_x, pupil_y, aaa, eee, woo, smile):
+def process(img, rotate_pitch, rotate_yaw, rotate_roll, blink, eyebrow, wink, pupil_x, pupil_y, aaa, eee, woo, smile, progress=gr.Progress()):
+    request_id = str(uuid.uuid4())
     try:
-        with open(EXPRESSION_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
-
-        # Validate JSON keys
-        if "14" not in prompt or "inputs" not in prompt["14"]:
-            raise KeyError("Key '14.inputs' is missing in the JSON structure.")
-        if "15" not in prompt or "inputs" not in prompt["15"]:
-            raise KeyError("Key '15.inputs' is missing in the JSON structure.")
+        img_filename = save_input_image(img)
 
-        # Update expression values in the prompt
-        prompt["14"]["inputs"].update({
+        # Node ids are validated by the template registry when the workflow is loaded
+        prompt = render_workflow("expression-edit", {"14": {
             "rotate_pitch": rotate_pitch,
             "rotate_yaw": rotate_yaw,
             "rotate_roll": rotate_roll,
@@ -44,12 +28,9 @@ def process(img, rotate_pitch, rotate_yaw, rotate_roll, blink, eyebrow, wink, pu
             "eee": eee,
             "woo": woo,
             "smile": smile
-        })
-
-        img_filename = save_input_image(img)
-        prompt["15"]["inputs"]["image"] = img_filename
+        }, "15": {"image": img_filename}})
 
-        images = get_prompt_images(prompt)
+        images = get_prompt_images(prompt, request_id, listener=progress_listener(progress), workflow="expression-edit")
         return images
     except Exception as e:
         print(f"Error during processing: {e}")
@@ -1,49 +1,35 @@
-import json
 import uuid
-from datetime import datetime
-from pathlib import Path
 import gradio as gr
 import random
-from PIL import Image
-from websockets_api import get_prompt_images
-from settings import EYEDETAILS_WORKFLOW, COMFY_UI_PATH
+from websockets_api import get_prompt_images, progress_listener
+from input_store import store_input_image
+from workflow_templates import render_workflow
 from fastapi import HTTPException
 import logging
 logger = logging.getLogger(__name__)
 
 def save_input_image(img):
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())
-    
-    input_dir = Path(COMFY_UI_PATH) / "input"
-    input_dir.mkdir(parents=True, exist_ok=True) 
-
-    input_img = input_dir / f"img_{timestamp}_{unique_id}.jpg"
-
-    pillow_image = Image.fromarray(img)
-    pillow_image.save(str(input_img)) 
-    
-    return input_img.name
+    return store_input_image(img)
 
-def process(img,freckles,eyes_details, iris_details, circular_iris, circular_pupil):
+def process(img,freckles,eyes_details, iris_details, circular_iris, circular_pupil, progress=gr.Progress()):
+    request_id = str(uuid.uuid4())
     try:
-        with open(EYEDETAILS_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
-
-        # Set a random seed for reproducibility
-        prompt["8"]["inputs"]["seed"] = random.randint(0,999999999999999)
-        prompt["5"]["inputs"].update({
-            "freckles": freckles,
-            "eyes_detail": eyes_details,
-            "iris_detail" : iris_details,
-            "circular_iris": circular_iris,
-            "circular_pupil": circular_pupil  
-        })
         img_filename = save_input_image(img)
 
-        prompt["1"]["inputs"]["image"] = img_filename
+        prompt = render_workflow("eye_details-edit", {
+            # Set a random seed for reproducibility
+            "8": {"seed": random.randint(0,999999999999999)},
+            "5": {
+                "freckles": freckles,
+                "eyes_details": eyes_details,
+                "iris_details" : iris_details,
+                "circular_iris": circular_iris,
+                "circular_pupil": circular_pupil
+            },
+            "1": {"image": img_filename},
+        })
         
-        images = get_prompt_images(prompt)
+        images = get_prompt_images(prompt, request_id, listener=progress_listener(progress), workflow="eye_details-edit")
         return images
     
     except Exception as e:
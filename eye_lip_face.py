@@ -1,20 +1,18 @@
-import json
 import uuid
 import random
 import logging
-from datetime import datetime
-from pathlib import Path
-from PIL import Image
 from fastapi import HTTPException
 import gradio as gr
-from websockets_api import get_prompt_images
-from settings import EYE_LIP_FACE_WORKFLOW, COMFY_UI_PATH
+from websockets_api import get_prompt_images, progress_listener
+from input_store import store_input_image
+from workflow_templates import render_workflow
 
 logger = logging.getLogger(__name__)
 
 def save_input_image(img):
     """
-    Saves the input image to the ComfyUI input directory with a unique name.
+    Saves the input image to the ComfyUI input directory, named after its content so a
+    repeated image is stored only once.
 
     Args:
         img (numpy.ndarray): Image data in numpy array format.
@@ -23,20 +21,12 @@ def save_input_image(img):
         str: The name of the saved image file.
     """
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        unique_id = str(uuid.uuid4())
-        input_dir = Path(COMFY_UI_PATH) / "input"
-        input_dir.mkdir(parents=True, exist_ok=True)
-        
-        input_img = input_dir / f"img_{timestamp}_{unique_id}.jpg"
-        pillow_image = Image.fromarray(img)
-        pillow_image.save(str(input_img))
-        return input_img.name
+        return store_input_image(img)
     except Exception as e:
         logger.error(f"Error saving input image: {e}")
         raise HTTPException(status_code=500, detail="Failed to save input image.")
 
-def process(img, eyes_color, eyes_shape, lips_color, lips_shape, face_shape, slider):
+def process(img, eyes_color, eyes_shape, lips_color, lips_shape, face_shape, slider, progress=gr.Progress()):
     """
     Processes the input image and generates new images based on the provided parameters.
 
@@ -48,32 +38,33 @@ def process(img, eyes_color, eyes_shape, lips_color, lips_shape, face_shape, sli
         lips_shape (str): Selected lip shape.
         face_shape (str): Selected face shape.
         slider (float): Denoising weight.
+        progress (gr.Progress): Progress tracker injected by Gradio, fed from ComfyUI events.
 
     Returns:
         list: A list of generated images.
     """
+    request_id = str(uuid.uuid4())
     try:
-        with open(EYE_LIP_FACE_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
+        img_filename = save_input_image(img)
 
         # Set a random seed and update prompt details
-        prompt["27"]["inputs"].update({
-            "seed": random.randint(0, 9999999999999999),
-            "denoise": slider
-        })
-        prompt["21"]["inputs"].update({
-            "eyes_color": eyes_color,
-            "eyes_shape": eyes_shape,
-            "lips_color": lips_color,
-            "lips_shape": lips_shape,
-            "face_shape": face_shape
+        prompt = render_workflow("eye_lip_face-edit", {
+            "27": {
+                "seed": random.randint(0, 9999999999999999),
+                "denoise": slider
+            },
+            "21": {
+                "eyes_color": eyes_color,
+                "eyes_shape": eyes_shape,
+                "lips_color": lips_color,
+                "lips_shape": lips_shape,
+                "face_shape": face_shape
+            },
+            "14": {"image": img_filename},
         })
 
-        img_filename = save_input_image(img)
-        prompt["14"]["inputs"]["image"] = img_filename
-
         # Generate images using the prompt
-        images = get_prompt_images(prompt)
+        images = get_prompt_images(prompt, request_id, listener=progress_listener(progress), workflow="eye_lip_face-edit")
         return images
     except Exception as e:
         logger.error(f"Expression editing error: {e}")
@@ -1,13 +1,9 @@
-import numpy as np
-import json
 import uuid
-from datetime import datetime
-from pathlib import Path
 import gradio as gr
 import random
-from PIL import Image
-from websockets_api import get_prompt_images
-from settings import HAIR_WORKFLOW, COMFY_UI_PATH
+from websockets_api import get_prompt_images, progress_listener
+from input_store import store_input_image
+from workflow_templates import render_workflow
 from fastapi import HTTPException
 import logging
 logger = logging.getLogger(__name__)
@@ -15,26 +11,9 @@ logger = logging.getLogger(__name__)
 def save_input_image(img):
     if isinstance(img, str):
         raise ValueError(f"Expected an image array, but got a string: {img}")
-    elif isinstance(img, Image.Image):
-        img = np.array(img)
-    elif not isinstance(img, np.ndarray):
-        raise TypeError(f"Expected img to be a NumPy array, got {type(img)} instead.")
 
-    # Ensure the 'input' directory exists
-    input_dir = Path(COMFY_UI_PATH) / "input"
-    input_dir.mkdir(parents=True, exist_ok=True)
-
-    # Create a unique filename
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())
-    input_img_path = input_dir / f"img_{timestamp}_{unique_id}.jpg"
-
-    # Save the image
-    pillow_image = Image.fromarray(img)
-    pillow_image.save(input_img_path)
-
-    #print(f"Image saved at: {input_img_path}")  # Debugging line
-    return input_img_path 
+    # Stored under its content hash; the same photo edited again reuses the existing file
+    return store_input_image(img)
 
 # Dictionary for hairstyles
 hairstyles = {
@@ -90,26 +69,23 @@ hairstyles = {
     "Windy Day": "A braided headband keeps hair secure while remaining stylish, ideal for a windy day."
 }
 
-def process(img, hair_color, hairstyle, slider):
+def process(img, hair_color, hairstyle, slider, progress=gr.Progress()):
+    request_id = str(uuid.uuid4())
     try:
-        with open(HAIR_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
-
-        prompt["156"]["inputs"]["seed"] = random.randint(0, 99999999999999999)
-        
         # Set the hairstyle description
         text2 = f"{hairstyle}, with {hair_color} hair color"
 
-        prompt["228"]["inputs"]["text"] = text2
-        prompt["156"]["inputs"]["denoise"] = slider
-
         # Save the image and get its path
         img_filename = save_input_image(img)
-        # Convert Path to string to avoid serialization issues
-        prompt["138"]["inputs"]["image"] = str(img_filename)
+
+        prompt = render_workflow("hair-edit", {
+            "156": {"seed": random.randint(0, 99999999999999999), "denoise": slider},
+            "228": {"text": text2},
+            "138": {"image": img_filename},
+        })
 
         # Call the function to process the prompt and get the result images
-        images = get_prompt_images(prompt)
+        images = get_prompt_images(prompt, request_id, listener=progress_listener(progress), workflow="hair-edit")
         return images
     
     except Exception as e:
@@ -0,0 +1,155 @@
+import io
+import os
+import re
+import uuid
+import hashlib
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from settings import (COMFY_UI_PATH, INPUT_TRANSPORT, INPUT_STAGING_PATH, MAX_UPLOAD_BYTES, MAX_IMAGE_PIXELS,
+                      UPLOAD_CHUNK_SIZE)
+
+# Inputs are named after the SHA-256 of their content, so an image uploaded again maps to the
+# file already in ComfyUI/input and LoadImage's cache sees the same image instead of a new one
+INPUT_NAME = re.compile(r"^in_([0-9a-f]{64})\.\w+$")
+
+def input_dir() -> Path:
+    # With the upload transport ComfyUI's disk is not reachable; inputs are staged locally and
+    # copied to each backend on first use
+    path = Path(INPUT_STAGING_PATH) if INPUT_TRANSPORT == "upload" else Path(COMFY_UI_PATH) / "input"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+def input_name(digest, extension=".jpg"):
+    return f"in_{digest}{extension}"
+
+def input_digest(name):
+    """The content hash embedded in a stored input's name, or None for any other file."""
+    match = INPUT_NAME.match(os.path.basename(str(name)))
+    return match.group(1) if match else None
+
+def prompt_inputs(prompt):
+    """Names of the stored inputs a rendered prompt loads."""
+    return {
+        value
+        for node in prompt.values()
+        for value in node.get("inputs", {}).values()
+        if isinstance(value, str) and input_digest(value)
+    }
+
+def write_atomic(path: Path, data: bytes):
+    # Write to a hidden temp file next to the target and rename it over, so ComfyUI never
+    # sees a half-written image and two writers of the same content cannot corrupt it
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+class InputRejected(ValueError):
+    """An upload that is too large, has too many pixels or is not a supported image."""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+# Leading bytes of the formats ComfyUI's LoadImage can open, with the extension they are stored under
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+    (b"BM", ".bmp"),
+    (b"II*\x00", ".tiff"),
+    (b"MM\x00*", ".tiff"),
+]
+
+def sniff_extension(head: bytes):
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    for signature, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    return None
+
+def store_input_stream(stream, max_bytes=MAX_UPLOAD_BYTES, max_pixels=MAX_IMAGE_PIXELS) -> str:
+    """
+    Copies an uploaded file object into the input folder in UPLOAD_CHUNK_SIZE pieces, hashing
+    as it goes, and returns the content-addressed name. Blocking; run it in a worker thread.
+
+    Raises InputRejected as soon as the data is known to be bad: on the first chunk if it is
+    not an image, past max_bytes while copying, and before publishing if the header declares
+    more than max_pixels.
+    """
+    directory = input_dir()
+    tmp_path = directory / f".upload.{uuid.uuid4().hex}.tmp"
+    digest = hashlib.sha256()
+    size = 0
+    extension = None
+    try:
+        with open(tmp_path, "wb") as f:
+            while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+                if extension is None:
+                    extension = sniff_extension(chunk[:16])
+                    if extension is None:
+                        raise InputRejected("Upload is not a supported image.", 415)
+                size += len(chunk)
+                if size > max_bytes:
+                    raise InputRejected(f"Upload exceeds {max_bytes} bytes.", 413)
+                digest.update(chunk)
+                f.write(chunk)
+        if extension is None:
+            raise InputRejected("Upload is empty.", 415)
+
+        # Only the header is parsed here; the pixels are decoded by ComfyUI
+        try:
+            with Image.open(tmp_path) as image:
+                width, height = image.size
+        except Image.DecompressionBombError:
+            raise InputRejected(f"Image has more than {max_pixels} pixels.", 413)
+        except Exception:
+            raise InputRejected("Upload is not a readable image.", 415)
+        if width * height > max_pixels:
+            raise InputRejected(f"Image is {width}x{height}, more than {max_pixels} pixels.", 413)
+
+        path = directory / input_name(digest.hexdigest(), extension)
+        try:
+            # Already stored: mark it as recently used, so the reaper keeps it
+            os.utime(path)
+            tmp_path.unlink()
+        except FileNotFoundError:
+            os.replace(tmp_path, path)
+        return path.name
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+def store_input_image(img) -> str:
+    """
+    Stores a numpy array or PIL image (as handed over by Gradio) and returns the file name.
+
+    The name is derived from the decoded pixels, so a repeat of the same picture is found
+    without encoding it again; only a new image is encoded to JPEG and written.
+    """
+    if isinstance(img, Image.Image):
+        img = np.array(img)
+    elif not isinstance(img, np.ndarray):
+        raise TypeError(f"Expected img to be a NumPy array, got {type(img)} instead.")
+    img = np.ascontiguousarray(img.astype(np.uint8, copy=False))
+    digest = hashlib.sha256(f"{img.shape}:{img.dtype}:".encode("utf-8"))
+    digest.update(img.data)
+
+    path = input_dir() / input_name(digest.hexdigest())
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pillow_image = Image.fromarray(img)
+        if pillow_image.mode not in ("RGB", "L"):
+            pillow_image = pillow_image.convert("RGB")
+        buffer = io.BytesIO()
+        pillow_image.save(buffer, format="JPEG")
+        write_atomic(path, buffer.getvalue())
+    return path.name
@@ -0,0 +1,148 @@
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from async_websockets_api import get_prompt_images, cancel_prompt
+from submission_ledger import ledger
+from result_cache import result_cache, cacheable
+from settings import JOB_RETENTION, JOB_EVENT_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = {DONE, FAILED, CANCELLED}
+
+class Job:
+    """In-process state of one workflow run submitted in job mode."""
+
+    def __init__(self, workflow, id=None):
+        # The job id doubles as the submission ledger's request id
+        self.id = id or str(uuid.uuid4())
+        self.workflow = workflow
+        self.status = QUEUED
+        self.progress = {"node": None, "value": 0, "max": 0}
+        self.prompt_id = None
+        self.rows = []
+        self.error = None
+        self.queue_position = None
+        self.created_at = datetime.utcnow()
+        self.updated_at = self.created_at
+        self.task = None
+        # (queue, wants previews) for each open progress stream
+        self.subscribers = []
+
+    def subscribe(self, previews=False):
+        queue = asyncio.Queue(maxsize=JOB_EVENT_QUEUE_SIZE)
+        self.subscribers.append((queue, previews))
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers = [(q, previews) for q, previews in self.subscribers if q is not queue]
+
+    def publish(self, event, data):
+        for queue, previews in self.subscribers:
+            if event == "preview" and not previews:
+                continue
+            if queue.full():
+                # A slow reader loses the oldest update, never the latest state
+                queue.get_nowait()
+            queue.put_nowait((event, data))
+
+    def on_event(self, message):
+        # Listener attached to the prompt's WebSocket events
+        event, data = message["type"], message["data"]
+        if event == "preview":
+            self.publish("preview", data)
+            return
+        self.prompt_id = self.prompt_id or data.get("prompt_id")
+        if event in ("execution_start", "execution_cached", "executing") and self.status == QUEUED:
+            self.status = RUNNING
+        if event == "executing" and data.get("node") is not None:
+            self.progress = {"node": data["node"], "value": 0, "max": 0}
+        elif event == "progress":
+            self.progress = {"node": data.get("node"), "value": data.get("value", 0), "max": data.get("max", 0)}
+        if self.status == RUNNING:
+            self.queue_position = 0
+        self.updated_at = datetime.utcnow()
+        self.publish("status", self.to_dict())
+
+    def set_queue_position(self, position):
+        if self.status == QUEUED and position != self.queue_position:
+            self.queue_position = position
+            self.publish("status", self.to_dict())
+
+    def finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.updated_at = datetime.utcnow()
+        self.publish(status, self.to_dict())
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "workflow": self.workflow,
+            "status": self.status,
+            "progress": self.progress,
+            "queue_position": self.queue_position,
+            "prompt_id": self.prompt_id or ledger.prompt_id(self.id),
+            "image_ids": [row["id"] for row in self.rows],
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat(),
+        }
+
+jobs = OrderedDict()
+
+def _evict_finished():
+    # Keep every unfinished job; drop the oldest finished ones past the retention limit
+    finished = [job_id for job_id, job in jobs.items() if job.status in FINISHED]
+    for job_id in finished[:max(0, len(jobs) - JOB_RETENTION)]:
+        del jobs[job_id]
+
+async def _run(job, prompt, cache_key=None):
+    try:
+        rows = await get_prompt_images(prompt, request_id=job.id, listener=job.on_event, workflow=job.workflow,
+                                       keep_slots=cache_key is not None)
+        job.rows = [row for row in rows if row is not None]
+        if cache_key is not None and cacheable(rows):
+            result_cache.put(cache_key, job.rows)
+        job.finish(DONE)
+    except asyncio.CancelledError:
+        job.finish(CANCELLED)
+    except Exception as e:
+        logger.error(f"Job {job.id} ({job.workflow}) failed: {e}")
+        job.finish(FAILED, str(e))
+
+def submit_job(workflow, prompt, cache_key=None, request_id=None):
+    job = Job(workflow, request_id)
+    jobs[job.id] = job
+    _evict_finished()
+    job.task = asyncio.create_task(_run(job, prompt, cache_key))
+    return job
+
+def completed_job(workflow, rows):
+    # A job answered straight from the result cache
+    job = Job(workflow)
+    job.rows = rows
+    job.finish(DONE)
+    jobs[job.id] = job
+    _evict_finished()
+    return job
+
+def get_job(job_id):
+    return jobs.get(job_id)
+
+async def cancel_job(job):
+    if job.status in FINISHED:
+        return job
+    prompt_id = job.prompt_id or ledger.prompt_id(job.id)
+    if prompt_id:
+        await cancel_prompt(prompt_id)
+    job.task.cancel()
+    try:
+        await job.task
+    except asyncio.CancelledError:
+        pass
+    job.finish(CANCELLED)
+    return job
@@ -1,57 +1,47 @@
-import json
 import uuid
-from datetime import datetime
-from pathlib import Path
 import gradio as gr
 import random
-from PIL import Image
-from websockets_api import get_prompt_images
-from settings import MAKEUP_WORKFLOW, COMFY_UI_PATH
+from websockets_api import get_prompt_images, progress_listener
+from input_store import store_input_image
+from workflow_templates import render_workflow
 from fastapi import HTTPException
 import logging
 logger = logging.getLogger(__name__)
 
-# Save input image and reference image into the input folder inside ComfyUI with unique filenames
+# Save the input image into the input folder inside ComfyUI, named after its content
 def save_input_image(img):
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())
-    input_img = Path(COMFY_UI_PATH) / f"input/img_{timestamp}_{unique_id}.jpg"
+    return store_input_image(img)
 
-    pillow_image = Image.fromarray(img)
-    pillow_image.save(input_img)
-
-    return input_img.name
-
-def process(img, makeup_style, eyeshadow, eyeliner, mascara, blush, lipstick, lip_gloss, slider):
+def process(img, makeup_style, eyeshadow, eyeliner, mascara, blush, lipstick, lip_gloss, slider, progress=gr.Progress()):
+    request_id = str(uuid.uuid4())
     try:
-        with open(MAKEUP_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
-
         # Validate and convert slider value
         try:
             slider_value = float(slider)
         except ValueError:
             raise ValueError(f"Invalid slider value: {slider}. Please provide a number between 0 and 1.")
 
-        prompt["7"]["inputs"]["seed"] = random.randint(0,999999999999999)
-        # Set dynamic inputs in the workflow
-        prompt["13"]["inputs"]["denoise"] = slider_value
-        prompt["9"]["inputs"].update({
-            "makeup_style": makeup_style,
-            "eyeshadow": eyeshadow == "True",
-            "eyeliner": eyeliner == "True",
-            "mascara": mascara == "True",
-            "blush": blush == "True",
-            "lipstick": lipstick == "True",
-            "lip_gloss": lip_gloss == "True"
-        })
-
         # Save the input image
         img_filename = save_input_image(img)
-        prompt["1"]["inputs"]["image"] = img_filename
+
+        # Set dynamic inputs in the workflow
+        prompt = render_workflow("makeup-edit", {
+            "7": {"seed": random.randint(0,999999999999999)},
+            "13": {"denoise": slider_value},
+            "9": {
+                "makeup_style": makeup_style,
+                "eyeshadow": eyeshadow == "True",
+                "eyeliner": eyeliner == "True",
+                "mascara": mascara == "True",
+                "blush": blush == "True",
+                "lipstick": lipstick == "True",
+                "lip_gloss": lip_gloss == "True"
+            },
+            "1": {"image": img_filename},
+        })
 
         # Call the image generation function
-        images = get_prompt_images(prompt)
+        images = get_prompt_images(prompt, request_id, listener=progress_listener(progress), workflow="makeup-edit")
         return images
 
     except Exception as e:
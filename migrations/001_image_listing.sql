@@ -0,0 +1,9 @@
+-- Brings a database created from an older db.sql up to date for the paginated GET /images.
+-- CREATE INDEX CONCURRENTLY does not lock out inserts but cannot run inside a transaction:
+-- apply with `psql -f migrations/001_image_listing.sql`, not with --single-transaction.
+ALTER TABLE generated_images ADD COLUMN IF NOT EXISTS workflow TEXT;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS generated_images_upload_time_idx ON generated_images (upload_time, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS generated_images_client_id_idx ON generated_images (client_id, upload_time, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS generated_images_prompt_id_idx ON generated_images (prompt_id, upload_time, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS generated_images_workflow_idx ON generated_images (workflow, upload_time, id);
@@ -0,0 +1,64 @@
+"""
+Moves result files from the flat RESULTS_PATH into the sharded layout (RESULTS_PATH/ab/cd/<name>)
+and rewrites generated_images.image_output_path to the path relative to RESULTS_PATH.
+
+Safe to run while the API is up, and again after an interruption: GET /results/{name} finds a
+file in either layout, and files and rows already migrated are left alone.
+
+    python migrations/002_shard_results.py
+"""
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from psycopg2.extras import execute_values
+from db_pool import db_connection
+from output_store import result_name, result_relative_path
+from settings import RESULTS_PATH
+
+BATCH = 1000
+
+def move_files():
+    moved = 0
+    for path in Path(RESULTS_PATH).iterdir():
+        if not path.is_file() or path.name.startswith("."):
+            continue
+        target = Path(RESULTS_PATH) / result_relative_path(path.name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(path, target)
+        moved += 1
+    return moved
+
+def rewrite_rows():
+    updated = 0
+    last_id = 0
+    while True:
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT id, image_output_path FROM generated_images WHERE id > %s ORDER BY id LIMIT %s",
+                    (last_id, BATCH),
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    return updated
+                last_id = rows[-1][0]
+                changes = [
+                    (id, result_relative_path(result_name(stored)))
+                    for id, stored in rows
+                    if stored != result_relative_path(result_name(stored))
+                ]
+                if changes:
+                    execute_values(cursor, """
+                        UPDATE generated_images AS g SET image_output_path = v.path
+                        FROM (VALUES %s) AS v (id, path)
+                        WHERE g.id = v.id
+                    """, changes)
+                updated += len(changes)
+
+if __name__ == "__main__":
+    # Files first: a rewritten row must never point at a shard its file has not reached yet
+    print(f"Moved {move_files()} file(s) into shards under {RESULTS_PATH}")
+    print(f"Rewrote image_output_path of {rewrite_rows()} row(s)")
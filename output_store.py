@@ -0,0 +1,185 @@
+import io
+import os
+import uuid
+import shutil
+import hashlib
+import logging
+from pathlib import Path, PureWindowsPath
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from input_store import sniff_extension
+from settings import RESULTS_PATH, COMFY_UI_PATH, OUTPUT_FORMAT, OUTPUT_FORMATS, OUTPUT_ENCODE_WORKERS
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Pillow's encoders release the GIL, so threads encode a batch of outputs in parallel
+_executor = ThreadPoolExecutor(max_workers=OUTPUT_ENCODE_WORKERS, thread_name_prefix="encode")
+
+# format -> (Pillow format name, file extension, MIME type, default save options)
+ENCODINGS = {
+    "png": ("PNG", ".png", "image/png", {"compress_level": 3}),
+    "webp": ("WEBP", ".webp", "image/webp", {"quality": 90, "method": 4}),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg", {"quality": 95, "subsampling": 0}),
+}
+
+# ioctl that asks btrfs/XFS for a copy-on-write clone of a whole file
+FICLONE = 0x40049409
+
+def result_shard(name) -> str:
+    # Two levels of 256 directories keep every directory small however many results pile up. The
+    # extension is left out of the key, so the directory is known before the output format is.
+    digest = hashlib.sha256(os.path.splitext(name)[0].encode("utf-8")).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}"
+
+def result_name(stored) -> str:
+    """File name of a generated_images.image_output_path (older rows hold full, possibly Windows, paths)."""
+    return PureWindowsPath(str(stored)).name
+
+def result_relative_path(name) -> str:
+    # What image_output_path holds: the path under RESULTS_PATH, independent of where that is mounted
+    return f"{result_shard(name)}/{name}"
+
+def result_file(name) -> Path:
+    """Location of the result file `name`, sharded or, if not migrated yet, in the flat layout."""
+    path = Path(RESULTS_PATH) / result_relative_path(name)
+    return path if path.exists() else Path(RESULTS_PATH) / name
+
+def local_output_path(image) -> Path:
+    # Where the ComfyUI on this host wrote a /history output entry
+    return Path(COMFY_UI_PATH) / image.get("type", "output") / (image.get("subfolder") or "") / image["filename"]
+
+def output_format(workflow=None):
+    return OUTPUT_FORMATS.get(workflow, OUTPUT_FORMAT)
+
+def link_file(source: Path, path: Path):
+    """Hard-links `source` to `path`, else reflinks it, else copies it."""
+    try:
+        os.link(source, path)
+        return
+    except OSError:
+        pass
+    if fcntl is not None:
+        try:
+            with open(source, "rb") as src, open(path, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, path)
+
+# Metadata chunks dropped from results stored without re-encoding. ComfyUI's SaveImage writes
+# the whole prompt and workflow (seeds, model and input file names) into PNG text chunks, and
+# other save nodes put the same into EXIF/XMP; none of it should be served with the image.
+PNG_METADATA_CHUNKS = {b"tEXt", b"zTXt", b"iTXt", b"eXIf"}
+WEBP_METADATA_CHUNKS = {b"EXIF", b"XMP "}
+
+def _strip_png(data):
+    kept, pos = [data[:8]], 8
+    while pos + 12 <= len(data):
+        end = pos + 12 + int.from_bytes(data[pos:pos + 4], "big")
+        if data[pos + 4:pos + 8] not in PNG_METADATA_CHUNKS:
+            kept.append(data[pos:end])
+        pos = end
+    return b"".join(kept)
+
+def _strip_webp(data):
+    kept, pos = [b"WEBP"], 12
+    while pos + 8 <= len(data):
+        fourcc, size = data[pos:pos + 4], int.from_bytes(data[pos + 4:pos + 8], "little")
+        end = pos + 8 + size + (size & 1)
+        chunk = data[pos:end]
+        if fourcc == b"VP8X":
+            # Clear the "has EXIF" and "has XMP" flags along with the chunks
+            chunk = chunk[:8] + bytes([chunk[8] & ~0x0C & 0xFF]) + chunk[9:]
+        if fourcc not in WEBP_METADATA_CHUNKS:
+            kept.append(chunk)
+        pos = end
+    body = b"".join(kept)
+    return b"RIFF" + len(body).to_bytes(4, "little") + body
+
+def _strip_jpeg(data):
+    # APP1 (EXIF, XMP) and comment segments; APP2 and APP14 stay, as they affect the colors
+    kept, pos = [data[:2]], 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF and data[pos + 1] != 0xDA:
+        end = pos + 2 + int.from_bytes(data[pos + 2:pos + 4], "big")
+        if data[pos + 1] not in (0xE1, 0xFE):
+            kept.append(data[pos:end])
+        pos = end
+    kept.append(data[pos:])
+    return b"".join(kept)
+
+def strip_metadata(data: bytes) -> bytes:
+    """`data` without its metadata chunks, copied chunk by chunk; the pixels are not re-encoded."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return _strip_png(data)
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return _strip_webp(data)
+    if data[:2] == b"\xff\xd8":
+        return _strip_jpeg(data)
+    return data
+
+def source_extension(source):
+    if isinstance(source, Path):
+        return ".jpg" if source.suffix.lower() == ".jpeg" else source.suffix.lower()
+    if isinstance(source, bytes):
+        return sniff_extension(source[:16])
+    return None
+
+def write_output(source, path_stem, spec):
+    """
+    Stores one result image and returns (path, size in bytes, MIME type). `source` is a PIL
+    image, the encoded bytes fetched from ComfyUI or the path of the file ComfyUI wrote on
+    this host. Sources already in the configured format are stored as they are, minus their
+    metadata (a path without any is linked, not copied); anything else is decoded and encoded
+    exactly once, which drops the metadata as well.
+    """
+    options = dict(spec)
+    pil_format, extension, mime, defaults = ENCODINGS[options.pop("format", "png").lower()]
+    path = Path(f"{path_stem}{extension}")
+    if source_extension(source) == extension:
+        data = source.read_bytes() if isinstance(source, Path) else source
+        stripped = strip_metadata(data)
+        if isinstance(source, Path) and stripped == data:
+            link_file(source, path)
+        else:
+            path.write_bytes(stripped)
+    else:
+        image = source
+        if isinstance(source, Path):
+            image = Image.open(source)
+        elif isinstance(source, bytes):
+            image = Image.open(io.BytesIO(source))
+        if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(path, format=pil_format, **{**defaults, **options})
+    return path, path.stat().st_size, mime
+
+def _write_or_skip(source, path_stem, spec):
+    if source is None:
+        return None
+    try:
+        return write_output(source, path_stem, spec)
+    except Exception as e:
+        logger.error(f"Error storing result image {path_stem}: {e}")
+        return None
+
+def write_outputs(sources, client_id, spec):
+    """
+    Writes a batch of result images to their shard directories under RESULTS_PATH in parallel.
+    Returns the written (path, size, MIME type) tuples in input order, with None in place of
+    images that failed (or were None to begin with).
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    stems = []
+    for _ in sources:
+        stem = f"result_{client_id}_{timestamp}_{uuid.uuid4()}"
+        result_dir = Path(RESULTS_PATH) / result_shard(stem)
+        result_dir.mkdir(parents=True, exist_ok=True)
+        stems.append(result_dir / stem)
+    return list(_executor.map(_write_or_skip, sources, stems, [spec] * len(sources)))
@@ -0,0 +1,166 @@
+import io
+import os
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+from lru import LRUCache
+from input_store import input_dir, input_digest, input_name, write_atomic
+from workflow_templates import get_template
+from settings import PREPROCESS_WORKERS, PREPARED_INPUTS_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# "<input name>@<max side>" -> name of the right-sized copy, so a repeated input is prepared once
+prepared_inputs = LRUCache(PREPARED_INPUTS_CACHE_SIZE)
+
+_executor = None
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS)
+    return _executor
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+    _executor = None
+
+def prepare_input(directory, name, max_side):
+    """
+    Runs in a worker process. Returns the name of a copy of `name` whose longer side is at
+    most `max_side`, EXIF orientation applied and encoded once; inputs that already fit are
+    returned unchanged (ComfyUI's LoadImage applies their orientation itself).
+    """
+    path = Path(directory) / name
+    with Image.open(path) as image:
+        width, height = image.size
+        if max(width, height) <= max_side:
+            return name
+        source_format = image.format
+        if source_format == "JPEG":
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale instead of decoding every pixel
+            scale = max_side / max(width, height)
+            image.draft(image.mode, (int(width * scale) + 1, int(height * scale) + 1))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        if source_format == "JPEG":
+            image.save(buffer, format="JPEG", quality=95)
+            extension = ".jpg"
+        else:
+            # Keep alpha: LoadImage turns it into the mask output
+            image.save(buffer, format="PNG", compress_level=1)
+            extension = ".png"
+
+    data = buffer.getvalue()
+    prepared = Path(directory) / input_name(hashlib.sha256(data).hexdigest(), extension)
+    if not prepared.exists():
+        write_atomic(prepared, data)
+    return prepared.name
+
+async def prepare(name, max_side):
+    key = f"{name}@{max_side}"
+    prepared = prepared_inputs.get(key)
+    if prepared is not None:
+        try:
+            os.utime(input_dir() / prepared)
+        except FileNotFoundError:
+            # Removed by the reaper since; prepare it again
+            prepared = None
+    if prepared is None:
+        loop = asyncio.get_running_loop()
+        try:
+            prepared = await loop.run_in_executor(get_executor(), prepare_input, str(input_dir()), name, max_side)
+        except Exception as e:
+            # Let ComfyUI load the original; it reports anything really wrong with the file
+            logger.error(f"Preprocessing {name} failed, submitting it unchanged: {e}")
+            return name
+        prepared_inputs.put(key, prepared)
+    return prepared
+
+async def preprocess_inputs(workflow, values):
+    """Returns a copy of `values` whose stored inputs are replaced by copies sized for the workflow."""
+    max_side = get_template(workflow).max_side
+    slots = [
+        (node_id, name)
+        for node_id, inputs in values.items()
+        for name, value in inputs.items()
+        if isinstance(value, str) and input_digest(value)
+    ]
+    if not max_side or not slots:
+        return values
+    names = await asyncio.gather(*(prepare(values[node_id][name], max_side) for node_id, name in slots))
+    prepared = {node_id: dict(inputs) for node_id, inputs in values.items()}
+    for (node_id, name), prepared_name in zip(slots, names):
+        prepared[node_id][name] = prepared_name
+    return prepared
+
+if __name__ == "__main__":
+    # Compares what a 12 MP phone photo costs when ComfyUI decodes and resizes it in the graph
+    # with preprocessing it here first, for the hair-edit workflow (longer side 1500).
+    import time
+    import tempfile
+    import numpy as np
+
+    max_side = 1500
+    runs = 8
+    rng = np.random.default_rng(0)
+    # Smooth gradients plus noise compress roughly like a real photo
+    y, x = np.mgrid[0:3024, 0:4032]
+    pixels = np.stack([(x // 16) % 256, (y // 12) % 256, ((x + y) // 20) % 256], axis=-1)
+    pixels = np.clip(pixels + rng.normal(0, 12, pixels.shape), 0, 255).astype(np.uint8)
+    photo = Image.fromarray(pixels)
+    exif = photo.getexif()
+    exif[0x0112] = 6  # rotated 90 degrees, as phones store portrait shots
+    buffer = io.BytesIO()
+    photo.save(buffer, format="JPEG", quality=92, exif=exif.tobytes())
+    data = buffer.getvalue()
+
+    def comfy_load(path, resize_to=None):
+        # What LoadImage (plus JWImageResizeByLongerSide) does before the first GPU node
+        with Image.open(path) as image:
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            if resize_to:
+                image.thumbnail((resize_to, resize_to), Image.BICUBIC)
+            return np.asarray(image, dtype=np.float32) / 255.0
+
+    with tempfile.TemporaryDirectory() as directory:
+        name = input_name(hashlib.sha256(data).hexdigest())
+        (Path(directory) / name).write_bytes(data)
+
+        start = time.perf_counter()
+        for _ in range(runs):
+            comfy_load(Path(directory) / name, max_side)
+        baseline = (time.perf_counter() - start) / runs * 1000
+
+        start = time.perf_counter()
+        for _ in range(runs):
+            for prepared_name in list(Path(directory).glob("in_*")):
+                if prepared_name.name != name:
+                    prepared_name.unlink()
+            prepared = prepare_input(directory, name, max_side)
+        prepare_ms = (time.perf_counter() - start) / runs * 1000
+
+        start = time.perf_counter()
+        for _ in range(runs):
+            comfy_load(Path(directory) / prepared)
+        load_ms = (time.perf_counter() - start) / runs * 1000
+
+        prepared_size = (Path(directory) / prepared).stat().st_size
+        with Image.open(Path(directory) / prepared) as image:
+            prepared_dims = image.size
+
+        print(f"input            4032x3024 JPEG, {len(data) / 1e6:.1f} MB")
+        print(f"prepared         {prepared_dims[0]}x{prepared_dims[1]} JPEG, {prepared_size / 1e6:.1f} MB")
+        print(f"in-graph         decode + resize in ComfyUI        {baseline:7.1f} ms")
+        print(f"preprocessed     prepare (API worker) {prepare_ms:6.1f} ms + load in ComfyUI {load_ms:6.1f} ms")
+        print(f"ComfyUI time saved per request                     {baseline - load_ms:7.1f} ms")
+        print(f"end-to-end saved per request (first use)           {baseline - load_ms - prepare_ms:7.1f} ms")
+        print(f"end-to-end saved per request (repeat, cached)      {baseline - load_ms:7.1f} ms")
+        print(f"bytes to transfer with the upload transport        {len(data) / 1e6:.1f} MB -> {prepared_size / 1e6:.1f} MB")
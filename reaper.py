@@ -0,0 +1,223 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime, timedelta
+from db_pool import db_connection
+from input_store import input_dir
+from output_store import result_name
+from result_cache import result_cache
+from result_writer import image_rows
+from result_storage import get_result_storage
+from workflow_templates import WORKFLOW_TEMPLATES, SAVE_NODES, get_template
+from settings import (COMFY_UI_PATH, REAPER_INTERVAL, REAPER_MIN_AGE, REAPER_BATCH, INPUT_RETENTION, INPUT_QUOTA_BYTES,
+                      COMFY_OUTPUT_RETENTION, COMFY_OUTPUT_QUOTA_BYTES, RESULT_RETENTION, RESULTS_QUOTA_BYTES)
+
+logger = logging.getLogger(__name__)
+
+def _is_input(path):
+    # Only what this API stored (content-addressed inputs, older img_* uploads, abandoned temp
+    # files); anything else in ComfyUI/input was put there by hand
+    name = path.rsplit("/", 1)[-1]
+    return name.startswith(("in_", "img_", ".upload.")) or name.endswith(".tmp")
+
+def _output_prefixes():
+    # ComfyUI names what a save node writes "<filename_prefix>_<counter>_.png", under the
+    # subfolder the prefix may contain; other files in ComfyUI/output were not written for us
+    prefixes = set()
+    for name in WORKFLOW_TEMPLATES:
+        for node in get_template(name).prompt.values():
+            prefix = node.get("inputs", {}).get("filename_prefix")
+            if node.get("class_type") in SAVE_NODES and isinstance(prefix, str):
+                prefixes.add(prefix.replace("\\", "/") + "_")
+    return tuple(prefixes)
+
+def _output_filter():
+    prefixes = _output_prefixes()
+    return lambda path: path.startswith(prefixes)
+
+def reap_directory(directory, max_age=None, max_bytes=None, include=None):
+    """
+    Deletes files under `directory` older than `max_age` seconds, then the least recently
+    used (by mtime) until the rest fit in `max_bytes`. Only files whose path relative to
+    `directory` passes `include` are considered, and files younger than REAPER_MIN_AGE are
+    kept either way, as a running prompt may still need them. Returns (files, bytes) deleted.
+    """
+    directory = Path(directory)
+    if not directory.is_dir() or (max_age is None and max_bytes is None):
+        return 0, 0
+    now = time.time()
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = Path(root) / name
+            if include is not None and not include(path.relative_to(directory).as_posix()):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+
+    total = sum(size for _, size, _ in files)
+    deleted = reclaimed = 0
+    for mtime, size, path in files:
+        age = now - mtime
+        expired = max_age is not None and age > max_age
+        over_quota = max_bytes is not None and total > max_bytes
+        if age < REAPER_MIN_AGE or not (expired or over_quota):
+            # Oldest first: once one file survives both policies, every newer one does too
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+        deleted += 1
+        reclaimed += size
+    return deleted, reclaimed
+
+def _delete_result_rows(condition, params):
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                DELETE FROM generated_images
+                WHERE id IN (
+                    SELECT id FROM generated_images
+                    WHERE {condition}
+                    ORDER BY upload_time, id
+                    LIMIT %s
+                )
+                RETURNING id, image_output_path, COALESCE(file_size, 0)
+            """, (*params, REAPER_BATCH))
+            return cursor.fetchall()
+
+def _forget_results(rows):
+    # The rows are gone before their files, so a half-finished run leaves at most unreferenced
+    # files behind, never rows that point at nothing
+    storage = get_result_storage()
+    for _, stored, _ in rows:
+        try:
+            storage.delete(result_name(stored))
+        except Exception as e:
+            logger.warning(f"Could not delete result file {stored}: {e}")
+    ids = {id for id, _, _ in rows}
+    for id in ids:
+        image_rows.pop(id)
+    result_cache.discard_if(lambda cached: any(row["id"] in ids for row in cached))
+
+def reap_results(max_age=RESULT_RETENTION, max_bytes=RESULTS_QUOTA_BYTES):
+    """
+    Deletes generated_images rows, oldest first, older than `max_age` seconds or until the
+    rest fit in `max_bytes`, together with their result files. Returns (rows, bytes) deleted.
+    """
+    deleted = reclaimed = 0
+    newest = datetime.utcnow() - timedelta(seconds=REAPER_MIN_AGE)
+    if max_age is not None:
+        cutoff = min(datetime.utcnow() - timedelta(seconds=max_age), newest)
+        while rows := _delete_result_rows("upload_time < %s", (cutoff,)):
+            _forget_results(rows)
+            deleted += len(rows)
+            reclaimed += sum(size for _, _, size in rows)
+    if max_bytes is not None:
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT COALESCE(SUM(file_size), 0) FROM generated_images")
+                total = cursor.fetchone()[0]
+        while total > max_bytes:
+            with db_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT id, COALESCE(file_size, 0) FROM generated_images
+                        WHERE upload_time < %s
+                        ORDER BY upload_time, id
+                        LIMIT %s
+                    """, (newest, REAPER_BATCH))
+                    candidates = cursor.fetchall()
+            # Only as many of the oldest as it takes to get under the quota
+            chosen = []
+            remaining = total
+            for id, size in candidates:
+                if remaining <= max_bytes:
+                    break
+                chosen.append(id)
+                remaining -= size
+            if not chosen:
+                break
+            rows = _delete_result_rows("id = ANY(%s)", (chosen,))
+            _forget_results(rows)
+            size = sum(size for _, _, size in rows)
+            total -= size
+            deleted += len(rows)
+            reclaimed += size
+    return deleted, reclaimed
+
+class Reaper:
+    """Applies the retention and quota policies every REAPER_INTERVAL seconds and keeps per-run reports."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.reclaimed_bytes = 0
+        self.last_run = None
+        self.task = None
+
+    def run_once(self):
+        start = time.monotonic()
+        report = {}
+        policies = [
+            ("inputs", lambda: reap_directory(input_dir(), INPUT_RETENTION, INPUT_QUOTA_BYTES, include=_is_input)),
+            ("comfy_outputs", lambda: reap_directory(Path(COMFY_UI_PATH) / "output", COMFY_OUTPUT_RETENTION,
+                                                     COMFY_OUTPUT_QUOTA_BYTES, include=_output_filter())),
+            ("results", reap_results),
+        ]
+        for area, policy in policies:
+            try:
+                deleted, reclaimed = policy()
+                report[area] = {"deleted": deleted, "bytes_reclaimed": reclaimed}
+            except Exception as e:
+                logger.error(f"Reaping {area} failed: {e}")
+                report[area] = {"error": str(e)}
+        total = sum(area.get("bytes_reclaimed", 0) for area in report.values())
+        report.update({
+            "finished_at": datetime.utcnow().isoformat(),
+            "duration_ms": round((time.monotonic() - start) * 1000, 1),
+            "bytes_reclaimed": total,
+        })
+        with self.lock:
+            self.runs += 1
+            self.reclaimed_bytes += total
+            self.last_run = report
+        logger.info(f"Reaper reclaimed {total} bytes: {report}")
+        return report
+
+    async def _loop(self):
+        while True:
+            await asyncio.to_thread(self.run_once)
+            await asyncio.sleep(REAPER_INTERVAL)
+
+    def start(self):
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.task = None
+
+    def stats(self):
+        with self.lock:
+            return {"runs": self.runs, "bytes_reclaimed": self.reclaimed_bytes, "last_run": self.last_run}
+
+reaper = Reaper()
+
+if __name__ == "__main__":
+    # One pass, for deployments that run only the Gradio apps (e.g. from cron)
+    logging.basicConfig(level=logging.INFO)
+    print(reaper.run_once())
@@ -1,22 +1,75 @@
-import uuid
 import json
+import uuid
+import base64
+import email.utils
 import random
+import asyncio
+import math
+import hashlib
+import inspect
 import logging
+import itertools
 import psycopg2
 from pathlib import Path
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from typing import List, NamedTuple, Optional
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request, Query
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse, Response, FileResponse, RedirectResponse
+from pydantic import ConfigDict, ValidationError, create_model
 from psycopg2.extras import RealDictCursor
-from datetime import datetime
-from db_config import DB_CONFIG
-from websockets_api import get_prompt_images
-from fastapi.staticfiles import StaticFiles
-from settings import COMFY_UI_PATH, RESULTS_PATH, CLOTH_SWAP_WORKFLOW, EXPRESSION_WORKFLOW, CLOTH_BACKGROUND_WORKFLOW, MAKEUP_WORKFLOW, EYEDETAILS_WORKFLOW, EYE_LIP_FACE_WORKFLOW, HAIR_WORKFLOW,API_ADDRESS
+from db_pool import init_db_pool, close_db_pool, db_connection, get_db_pool
+from result_writer import init_result_writer, close_result_writer, get_result_writer, image_rows
+from async_websockets_api import get_prompt_images, get_queue_position, close_session, start_event_listener, stop_event_listener, get_pool
+from submission_ledger import ledger
+from jobs import submit_job, completed_job, get_job, cancel_job, QUEUED, DONE, FAILED, CANCELLED, FINISHED
+from workflow_templates import load_templates, render_workflow, render_sweep, get_template
+from input_store import store_input_stream, InputRejected
+from preprocess import preprocess_inputs, shutdown_executor
+from result_cache import result_cache, cache_material, cache_key, derive_seed, cacheable
+from output_store import ENCODINGS, result_file, result_name
+from derivatives import get_derivative, derivative_cache
+from result_storage import get_result_storage, IMMUTABLE
+from reaper import reaper
+from settings import (RESULTS_PATH, API_ADDRESS, MAX_UPLOAD_BYTES, JOB_QUEUE_POLL_INTERVAL, JOB_EVENT_HEARTBEAT,
+                      IMAGE_LIST_DEFAULT_LIMIT, IMAGE_LIST_MAX_LIMIT, DERIVATIVE_FORMAT, DERIVATIVE_MAX_WIDTH,
+                      RESULTS_ACCEL_REDIRECT, RESULTS_READ_MODE, RESULTS_PRESIGN_EXPIRY, UPLOAD_CHUNK_SIZE,
+                      BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY, BATCH_MAX_ITEMS, BATCH_MAX_FILES, SWEEP_MAX_VARIANTS)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
-app.mount("/results", StaticFiles(directory=RESULTS_PATH), name="results")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_templates()
+    get_result_storage()
+    await asyncio.to_thread(init_db_pool)
+    await asyncio.to_thread(init_result_writer)
+    await start_event_listener()
+    reaper.start()
+    yield
+    await reaper.stop()
+    await stop_event_listener()
+    await close_session()
+    shutdown_executor()
+    await asyncio.to_thread(close_result_writer)
+    close_db_pool()
+
+app = FastAPI(lifespan=lifespan)
+
+# Refuse oversized bodies from their Content-Length before the multipart form is parsed
+# (three inputs per request at most, BATCH_MAX_FILES for a batch, plus room for the form fields)
+@app.middleware("http")
+async def limit_request_size(request: Request, call_next):
+    content_length = request.headers.get("content-length")
+    if request.url.path.startswith("/batch/"):
+        limit = BATCH_MAX_FILES * MAX_UPLOAD_BYTES + 1024 * 1024
+    else:
+        limit = 3 * MAX_UPLOAD_BYTES + 65536
+    if content_length and content_length.isdigit() and int(content_length) > limit:
+        return JSONResponse(status_code=413, content={"detail": "Request body too large."})
+    return await call_next(request)
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,28 +79,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Helper function to save an input image
-def save_image(uploaded_file: UploadFile) -> str:
-    unique_id = str(uuid.uuid4())
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    input_path = Path(COMFY_UI_PATH) / "input"
-    input_path.mkdir(parents=True, exist_ok=True)
-    file_name = f"img_{timestamp}_{unique_id}.jpg"
-    file_path = input_path / file_name
+class StoredInput(NamedTuple):
+    """An upload a batch request already stored, passed to the workflow endpoints in place of the UploadFile."""
+    name: str
+    filename: str
 
+# Helper function to save an input image; returns its content-addressed name in ComfyUI/input.
+# The copy is chunked and runs in a worker thread so large uploads never block the event loop.
+async def save_image(uploaded_file: UploadFile) -> str:
+    if isinstance(uploaded_file, StoredInput):
+        return uploaded_file.name
     try:
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.file.read())
+        return await asyncio.to_thread(store_input_stream, uploaded_file.file)
+    except InputRejected as e:
+        logger.warning(f"Rejected upload {uploaded_file.filename}: {e}")
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except Exception as e:
-        logger.error(f"Error saving image {file_name}: {e}")
+        logger.error(f"Error saving image {uploaded_file.filename}: {e}")
         raise HTTPException(status_code=500, detail="Error saving image.")
 
-    return str(file_path)
-
 # Helper function to execute database queries
 def execute_query(query: str, params: tuple = ()) -> list:
     try:
-        with psycopg2.connect(**DB_CONFIG) as conn:
+        with db_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cursor:
                 cursor.execute(query, params)
                 return cursor.fetchall()
@@ -55,6 +109,18 @@ def execute_query(query: str, params: tuple = ()) -> list:
         logger.error(f"Database error: {e}")
         raise HTTPException(status_code=500, detail="Database error")
 
+def stream_query(query: str, params: tuple = (), itersize: int = 500):
+    """
+    Yields the rows of a query through a server-side cursor, `itersize` rows per round trip,
+    so a large result is never held in memory. The pooled connection is held until the
+    generator is exhausted or closed.
+    """
+    with db_connection() as conn:
+        with conn.cursor(name=f"stream_{uuid.uuid4().hex}", cursor_factory=RealDictCursor) as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, params)
+            yield from cursor
+
 # Generic function to construct image response
 def construct_image_response(results) -> list:
     return [
@@ -69,6 +135,127 @@ def construct_image_response(results) -> list:
         for row in results
     ]
 
+def job_response(submitted):
+    return JSONResponse(status_code=202, content={
+        "success": True,
+        "job": submitted.to_dict(),
+        "status_url": f"http://{API_ADDRESS}/jobs/{submitted.id}",
+        "result_url": f"http://{API_ADDRESS}/jobs/{submitted.id}/result",
+    })
+
+def sweep_variants(workflow: str, sweep: str):
+    """
+    Parses a sweep, a JSON object mapping endpoint parameters to a list of values or to a
+    {"start", "stop", "step"} range, into the grid of their combinations. Returns the grid as
+    parameter dicts and as the node patches of each variant.
+    """
+    targets = get_template(workflow).sweep
+    _, model = ENDPOINT_SIGNATURES[workflow]
+    try:
+        spec = json.loads(sweep)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="sweep must be a JSON object.")
+    if not isinstance(spec, dict) or not spec:
+        raise HTTPException(status_code=400, detail="sweep must be a JSON object.")
+    axes = []
+    for param, values in spec.items():
+        if param not in targets:
+            raise HTTPException(status_code=400, detail=f"{workflow} can sweep {', '.join(targets) or 'no parameters'}, not {param}.")
+        if isinstance(values, dict):
+            start, stop, step = values.get("start"), values.get("stop"), values.get("step")
+            if not all(isinstance(bound, (int, float)) for bound in (start, stop, step)) or step <= 0 or stop < start:
+                raise HTTPException(status_code=400, detail=f"The range of {param} needs numbers start <= stop and step > 0.")
+            count = min(math.floor((stop - start) / step + 1e-9) + 1, SWEEP_MAX_VARIANTS + 1)
+            values = [round(start + i * step, 6) for i in range(count)]
+        if not isinstance(values, list) or not values:
+            raise HTTPException(status_code=400, detail=f"{param} must be a list of values or a range.")
+        # Checked (and coerced) like the endpoint's own parameter, before any GPU time is spent
+        try:
+            values = [getattr(model(**{param: value}), param) for value in values]
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid {param} value: {e.errors()[0]['msg']}")
+        axes.append((param, values))
+    if math.prod(len(values) for _, values in axes) > SWEEP_MAX_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"A sweep runs at most {SWEEP_MAX_VARIANTS} variants.")
+
+    grid, variants = [], []
+    for combination in itertools.product(*(values for _, values in axes)):
+        patches = {}
+        for (param, _), value in zip(axes, combination):
+            node_id, name = targets[param]
+            patches.setdefault(node_id, {})[name] = value
+        grid.append({param: value for (param, _), value in zip(axes, combination)})
+        variants.append(patches)
+    return grid, variants
+
+def sweep_response(grid, results, cached=False) -> dict:
+    # Every variant has the same output nodes, and their images come back in variant order, one
+    # slot per output (None where an image could not be fetched or stored)
+    if len(results) % len(grid):
+        raise RuntimeError(f"{len(results)} output(s) do not split over {len(grid)} sweep variants.")
+    per_variant = len(results) // len(grid)
+    images = [
+        construct_image_response([row])[0] if row is not None else {"error": "Result image could not be stored."}
+        for row in results
+    ]
+    response = {"success": True, "grid": []}
+    for index, params in enumerate(grid):
+        slots = results[index * per_variant:(index + 1) * per_variant]
+        response["grid"].append({
+            "params": params,
+            "success": None not in slots,
+            "images": images[index * per_variant:(index + 1) * per_variant],
+        })
+    if cached:
+        response["cached"] = True
+    return response
+
+# Render and run a workflow, either inline or as a background job (job=true returns 202 at once).
+# In deterministic mode the seed is the given one or derived from the request, and identical
+# requests are answered from the result cache without touching ComfyUI. With a sweep, every
+# combination of the swept values runs in one branched prompt, all with the same seed, and the
+# answer is a grid of their images.
+async def run_workflow(workflow: str, values: dict, job: bool = False, deterministic: bool = False, seed: Optional[int] = None,
+                       sweep: Optional[str] = None):
+    # One submission ledger entry per API request, whether it runs inline or as a job
+    request_id = str(uuid.uuid4())
+    seed_input = get_template(workflow).seed
+    grid = variants = None
+    if sweep is not None:
+        if job:
+            raise HTTPException(status_code=400, detail="A sweep runs inline; it cannot be submitted as a job.")
+        grid, variants = sweep_variants(workflow, sweep)
+    key = None
+    if deterministic:
+        material = await asyncio.to_thread(cache_material, workflow, values)
+        if variants is not None:
+            material = f"{material}|sweep:{json.dumps(variants, sort_keys=True)}"
+        if seed is None:
+            seed = derive_seed(material)
+        key = cache_key(material, seed if seed_input else None)
+        cached = result_cache.get(key)
+        if cached is not None:
+            if job:
+                return job_response(completed_job(workflow, cached))
+            if grid is not None:
+                return sweep_response(grid, cached, cached=True)
+            return {"success": True, "cached": True, "images": construct_image_response(cached)}
+    if seed is not None and seed_input:
+        node_id, name = seed_input
+        # makeup-edit leaves its Seed node at the template value, so it may not be in values yet
+        values[node_id] = {**values.get(node_id, {}), name: seed}
+
+    values = await preprocess_inputs(workflow, values)
+    prompt = render_workflow(workflow, values) if variants is None else render_sweep(workflow, values, variants)
+    if job:
+        return job_response(submit_job(workflow, prompt, cache_key=key, request_id=request_id))
+    images = await get_prompt_images(prompt, request_id, workflow=workflow, keep_slots=key is not None or grid is not None)
+    if key is not None and cacheable(images):
+        result_cache.put(key, images)
+    if grid is not None:
+        return sweep_response(grid, images)
+    return {"success": True, "images": construct_image_response([row for row in images if row is not None])}
+
 # Endpoint for cloth swapping
 @app.post("/cloth-swap/")
 async def cloth_swap(
@@ -81,36 +268,37 @@ async def cloth_swap(
     right_arm: bool = False,
     left_leg: bool = False,
     right_leg: bool = False,
+    job: bool = False,
+    deterministic: bool = False,
+    seed: Optional[int] = None,
 ):
     try:
-        with open(CLOTH_SWAP_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
-
-        prompt["1"]["inputs"]["seed"] = random.randint(0, 999999999999999)
-        prompt["13"]["inputs"].update({
-            "top_clothes": top_clothes,
-            "bottom_clothes": bottom_clothes,
-            "torso_skin": torso_skin,
-            "left_arm": left_arm,
-            "right_arm": right_arm,
-            "left_leg": left_leg,
-            "right_leg": right_leg
-        })
+        values = {
+            "1": {"seed": random.randint(0, 999999999999999)},
+            "13": {
+                "top_clothes": top_clothes,
+                "bottom_clothes": bottom_clothes,
+                "torso_skin": torso_skin,
+                "left_arm": left_arm,
+                "right_arm": right_arm,
+                "left_leg": left_leg,
+                "right_leg": right_leg
+            },
+        }
 
         # Save images and handle saving errors in one block
         try:
-            prompt["17"]["inputs"]["image"] = save_image(input_image)
-            prompt["18"]["inputs"]["image"] = save_image(ref_image)
+            input_name, ref_name = await asyncio.gather(save_image(input_image), save_image(ref_image))
+            values["17"] = {"image": input_name}
+            values["18"] = {"image": ref_name}
         except HTTPException as save_exception:
             logger.error(f"Error saving images: {save_exception.detail}")
             raise save_exception
 
-        images = get_prompt_images(prompt)
-        return {"success": True, "images": images}
+        return await run_workflow("cloth-swap", values, job, deterministic, seed)
 
-    except json.JSONDecodeError as json_error:
-        logger.error(f"Error decoding JSON from workflow file: {json_error}")
-        raise HTTPException(status_code=500, detail="Workflow file error.")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Cloth swap error: {e}")
         raise HTTPException(status_code=500, detail="Cloth swap processing failed.")
@@ -131,11 +319,12 @@ async def expression_edit(
     eee: float = 0,
     woo: float = 0,
     smile: float = 0,
+    job: bool = False,
+    deterministic: bool = False,
+    seed: Optional[int] = None,
+    sweep: Optional[str] = None,
 ):
     try:
-        with open(EXPRESSION_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
-
         # Create a dictionary for inputs to avoid repetitive code
         inputs = {
             "rotate_pitch": rotate_pitch,
@@ -152,22 +341,19 @@ async def expression_edit(
             "smile": smile
         }
 
-        prompt["14"]["inputs"].update(inputs)
-
         # Save the image and handle potential errors
         try:
-            prompt["15"]["inputs"]["image"] = save_image(input_image)
+            image_name = await save_image(input_image)
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Error saving input image: {e}")
             raise HTTPException(status_code=500, detail="Error saving input image.")
 
-        # get_prompt_images could raise its own errors
-        images = get_prompt_images(prompt)
-        return {"success": True, "images": images}
+        return await run_workflow("expression-edit", {"14": inputs, "15": {"image": image_name}}, job, deterministic, seed, sweep)
 
-    except json.JSONDecodeError as e:
-        logger.error(f"Error decoding JSON from workflow file: {e}")
-        raise HTTPException(status_code=500, detail="Workflow file error.")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Expression editing error: {e}")
         raise HTTPException(status_code=500, detail="Expression editing processing failed.")
@@ -178,40 +364,39 @@ async def cloth_background(
     input_img: UploadFile = File(...),
     input_img_cloth: UploadFile = File(...),
     input_img_bg: UploadFile = File(...),
-    prompt_clothing_type: str = "clothing,"
+    prompt_clothing_type: str = "clothing,",
+    job: bool = False,
+    deterministic: bool = False,
+    seed: Optional[int] = None
 ):
     try:
-        # Load the workflow prompt
-        with open(CLOTH_BACKGROUND_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
-
-        # Generate a random seed
-        prompt["3"]["inputs"]["seed"] = random.randint(0, 999999999999999)
-
         # Validate prompt clothing type
         final_prompt = prompt_clothing_type.strip() or "clothing, pants"
         if len(final_prompt) > 100:
             logger.error("Prompt clothing type is too long")
             raise HTTPException(status_code=400, detail="Prompt clothing type is too long")
 
-        prompt["6"]["inputs"]["prompt"] = final_prompt
+        # Generate a random seed
+        values = {
+            "3": {"seed": random.randint(0, 999999999999999)},
+            "6": {"prompt": final_prompt},
+        }
 
         # Map the input images into the workflow and handle saving
         try:
-            prompt["1"]["inputs"]["image"] = save_image(input_img)
-            prompt["49"]["inputs"]["image"] = save_image(input_img_cloth)
-            prompt["37"]["inputs"]["image"] = save_image(input_img_bg)
+            names = await asyncio.gather(save_image(input_img), save_image(input_img_cloth), save_image(input_img_bg))
+            values["1"], values["49"], values["37"] = ({"image": name} for name in names)
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Error saving one or more images: {e}")
             raise HTTPException(status_code=500, detail="Error saving images.")
 
         # Process the images and return the result
-        images = get_prompt_images(prompt)
-        return {"success": True, "images": images}
+        return await run_workflow("cloth-background", values, job, deterministic, seed)
 
-    except json.JSONDecodeError as e:
-        logger.error(f"Error reading workflow file: {e}")
-        raise HTTPException(status_code=500, detail="Workflow file error.")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Cloth background processing error: {e}")
         raise HTTPException(status_code=500, detail="Cloth background processing failed.")
@@ -227,38 +412,42 @@ async def makeup_edit(
     blush : bool = False,
     lipstick: bool = False,
     lip_gloss: bool = False,
-    slider: float =0
+    slider: float =0,
+    job: bool = False,
+    deterministic: bool = False,
+    seed: Optional[int] = None,
+    sweep: Optional[str] = None
     ):
 
     try:
-        with open(MAKEUP_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
-
         # Validate and convert slider value
         try:
             slider_value = float(slider)
         except ValueError:
             raise ValueError(f"Invalid slider value: {slider}. Please provide a number between 0 and 1.")
 
-        # Set dynamic inputs in the workflow
-        prompt["13"]["inputs"]["denoise"] = slider_value
-        prompt["9"]["inputs"].update({
-            "makeup_style": makeup_style,
-            "eyeshadow": eyeshadow == "True",
-            "eyeliner": eyeliner == "True",
-            "mascara": mascara == "True",
-            "blush": blush == "True",
-            "lipstick": lipstick == "True",
-            "lip_gloss": lip_gloss == "True"
-        })
+        # Set dynamic inputs in the workflow (the flags arrive as real booleans here, not "True"/"False")
+        values = {
+            "13": {"denoise": slider_value},
+            "9": {
+                "makeup_style": makeup_style,
+                "eyeshadow": eyeshadow,
+                "eyeliner": eyeliner,
+                "mascara": mascara,
+                "blush": blush,
+                "lipstick": lipstick,
+                "lip_gloss": lip_gloss
+            },
+        }
 
         # Save the input image
-        prompt["1"]["inputs"]["image"] = save_image(img)
+        values["1"] = {"image": await save_image(img)}
 
         # Call the image generation function
-        images = get_prompt_images(prompt)
-        return images
+        return await run_workflow("makeup-edit", values, job, deterministic, seed, sweep)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Expression editing error: {e}")
         raise HTTPException(status_code=500, detail="Expression editing processing failed.")
@@ -271,26 +460,30 @@ async def eye_details_edit(
     eyes_details: float = 0,
     iris_details: float = 0,
     circular_iris: float = 0,
-    circular_pupil: float = 0
+    circular_pupil: float = 0,
+    job: bool = False,
+    deterministic: bool = False,
+    seed: Optional[int] = None,
+    sweep: Optional[str] = None
 ):
     try:
-        with open(EYEDETAILS_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
-
         # Set a random seed for reproducibility
-        prompt["8"]["inputs"]["seed"] = random.randint(0,999999999999999)
-        prompt["5"]["inputs"].update({
-            "freckles": freckles,
-            "eyes_detail": eyes_details,
-            "iris_detail" : iris_details,
-            "circular_iris": circular_iris,
-            "circular_pupil": circular_pupil 
-        })
-        prompt["1"]["inputs"]["image"] = save_image(img)
-        
-        images = get_prompt_images(prompt)
-        return images
+        values = {
+            "8": {"seed": random.randint(0,999999999999999)},
+            "5": {
+                "freckles": freckles,
+                "eyes_details": eyes_details,
+                "iris_details" : iris_details,
+                "circular_iris": circular_iris,
+                "circular_pupil": circular_pupil
+            },
+            "1": {"image": await save_image(img)},
+        }
 
+        return await run_workflow("eye_details-edit", values, job, deterministic, seed, sweep)
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Expression editing error: {e}")
         raise HTTPException(status_code=500, detail="Expression editing processing failed.")
@@ -304,28 +497,31 @@ async def eye_lip_face_edit(
     lips_color: str="-",
     lips_shape: str="-",
     face_shape: str="-",
-    slider: float =0
+    slider: float =0,
+    job: bool = False,
+    deterministic: bool = False,
+    seed: Optional[int] = None,
+    sweep: Optional[str] = None
     ):
     try:
-        with open(EYE_LIP_FACE_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
-
         # Set a random seed for reproducibility
-        prompt["27"]["inputs"]["seed"] = random.randint(0,9999999999999999)
-        prompt["21"]["inputs"]["face_shape_weight"] = slider
-        prompt["21"]["inputs"].update({
-            "eyes_color": eyes_color,
-            "eyes_shape": eyes_shape,
-            "lips_color": lips_color,
-            "lips_shape": lips_shape,
-            "face_shape": face_shape
-        })
+        values = {
+            "27": {"seed": random.randint(0,9999999999999999)},
+            "21": {
+                "face_shape_weight": slider,
+                "eyes_color": eyes_color,
+                "eyes_shape": eyes_shape,
+                "lips_color": lips_color,
+                "lips_shape": lips_shape,
+                "face_shape": face_shape
+            },
+            "14": {"image": await save_image(img)},
+        }
 
-        prompt["14"]["inputs"]["image"] = save_image(img)
-        
-        images = get_prompt_images(prompt)
-        return images
+        return await run_workflow("eye_lip_face-edit", values, job, deterministic, seed, sweep)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Expression editing error: {e}")
         raise HTTPException(status_code=500, detail="Expression editing processing failed.")
@@ -335,86 +531,477 @@ async def hair_edit(
     img: UploadFile = File(...),
     hair_color: str="-",
     hairstyle: str="-",
-    slider: float =0
+    slider: float =0,
+    job: bool = False,
+    deterministic: bool = False,
+    seed: Optional[int] = None,
+    sweep: Optional[str] = None
     ):
     try:
-        with open(HAIR_WORKFLOW, "r", encoding="utf-8") as f:
-            prompt = json.load(f)
-
-        prompt["156"]["inputs"]["seed"] = random.randint(0, 99999999999999999)
-        
         # Set the hairstyle description
         text2 = f"{hairstyle}, with {hair_color} hair color"
 
-        prompt["228"]["inputs"]["text"] = text2
-        prompt["156"]["inputs"]["denoise"] = slider
-
-        prompt["138"]["inputs"]["image"] = save_image(img)
+        values = {
+            "156": {"seed": random.randint(0, 99999999999999999), "denoise": slider},
+            "228": {"text": text2},
+            "138": {"image": await save_image(img)},
+        }
 
         # Call the function to process the prompt and get the result images
-        images = get_prompt_images(prompt)
-        return images
+        return await run_workflow("hair-edit", values, job, deterministic, seed, sweep)
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Expression editing error: {e}")
         raise HTTPException(status_code=500, detail="Expression editing processing failed.")
 
-# GET images by ID
-@app.get("/images/{id}")
-def get_images_by_id(id: int):
-    query = """
-        SELECT id, client_id, prompt_id, image_output_path, file_size, file_type, upload_time
-        FROM generated_images
-        WHERE id = %s
-    """
-    results = execute_query(query, (id,))
+# Workflow endpoints that POST /batch/{workflow} can drive; each item of a batch is one call
+# of the endpoint, so batch items behave exactly like single requests
+BATCH_HANDLERS = {
+    "cloth-swap": cloth_swap,
+    "expression-edit": expression_edit,
+    "cloth-background": cloth_background,
+    "makeup-edit": makeup_edit,
+    "eye_details-edit": eye_details_edit,
+    "eye_lip_face-edit": eye_lip_face_edit,
+    "hair-edit": hair_edit,
+}
+
+def endpoint_signature(workflow):
+    """(input fields, parameter model) of a workflow endpoint, taken from its signature; used by batches and sweeps."""
+    parameters = inspect.signature(BATCH_HANDLERS[workflow]).parameters.values()
+    inputs = [parameter.name for parameter in parameters if parameter.annotation is UploadFile]
+    # job is left out: the batch itself streams every item's result
+    fields = {
+        parameter.name: (parameter.annotation, parameter.default)
+        for parameter in parameters
+        if parameter.annotation is not UploadFile and parameter.name != "job"
+    }
+    model = create_model(f"Params_{workflow.replace('-', '_')}", __config__=ConfigDict(extra="forbid"), **fields)
+    return inputs, model
+
+ENDPOINT_SIGNATURES = {workflow: endpoint_signature(workflow) for workflow in BATCH_HANDLERS}
+
+def batch_arguments(workflow, item, defaults, stored):
+    """Keyword arguments of the endpoint call for one batch item; raises HTTPException(422) if the item is invalid."""
+    inputs, model = ENDPOINT_SIGNATURES[workflow]
+    if not isinstance(item, dict) or not isinstance(item.get("inputs", {}), dict) or not isinstance(item.get("params", {}), dict):
+        raise HTTPException(status_code=422, detail='An item is an object with "inputs" and "params" objects.')
+    try:
+        arguments = model(**{**defaults, **item.get("params", {})}).model_dump()
+    except ValidationError as e:
+        errors = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+        raise HTTPException(status_code=422, detail=f"Invalid params: {errors}")
+    for field in inputs:
+        index = item.get("inputs", {}).get(field)
+        if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index < len(stored):
+            raise HTTPException(status_code=422, detail=f"inputs.{field} must be the index of one of the {len(stored)} uploaded files.")
+        if isinstance(stored[index], Exception):
+            # The upload was rejected; every item using it fails the way a single request would
+            raise stored[index]
+        arguments[field] = stored[index]
+    return arguments
+
+async def run_batch_item(workflow, index, item, defaults, stored, slots):
+    result = {"index": index}
+    if isinstance(item, dict) and "id" in item:
+        result["id"] = item["id"]
+    try:
+        arguments = batch_arguments(workflow, item, defaults, stored)
+        async with slots:
+            result.update(await BATCH_HANDLERS[workflow](**arguments))
+    except HTTPException as e:
+        result.update({"success": False, "status_code": e.status_code, "error": e.detail})
+    except Exception as e:
+        logger.error(f"Batch item {index} of {workflow} failed: {e}")
+        result.update({"success": False, "status_code": 500, "error": "Processing failed."})
+    return result
+
+async def batch_results(tasks):
+    # One NDJSON line per item in the order they finish, then a summary line
+    succeeded = 0
+    try:
+        for finished in asyncio.as_completed(tasks):
+            result = await finished
+            succeeded += bool(result.get("success"))
+            yield json.dumps(jsonable_encoder(result)) + "\n"
+        yield json.dumps({"done": True, "items": len(tasks), "succeeded": succeeded, "failed": len(tasks) - succeeded}) + "\n"
+    finally:
+        # The client went away: items still waiting for a slot are not started
+        for task in tasks:
+            task.cancel()
+
+# Batch endpoint: runs many items of one workflow from a single request. `files` are the uploads
+# and `items` a JSON list of {"id": ..., "inputs": {field: file index}, "params": {...}}, where the
+# fields and params are those of the workflow's own endpoint and `params` (a JSON object) holds
+# defaults for every item. Each file is stored once however many items use it. Items run
+# `concurrency` at a time and their results stream back as application/x-ndjson as each
+# finishes; a failed item is reported in its line and does not stop the others.
+@app.post("/batch/{workflow}")
+async def run_batch(
+    workflow: str,
+    items: str = Form(...),
+    files: List[UploadFile] = File(default=[]),
+    params: str = Form("{}"),
+    concurrency: int = Query(BATCH_CONCURRENCY, ge=1, le=BATCH_MAX_CONCURRENCY),
+):
+    if workflow not in BATCH_HANDLERS:
+        raise HTTPException(status_code=404, detail=f"Unknown workflow {workflow}. Batches run: {', '.join(BATCH_HANDLERS)}.")
+    try:
+        items = json.loads(items)
+        defaults = json.loads(params)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="items and params must be JSON.")
+    if not isinstance(items, list) or not items or not isinstance(defaults, dict):
+        raise HTTPException(status_code=400, detail="items must be a non-empty JSON list and params a JSON object.")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} items per batch.")
+    if len(files) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_FILES} files per batch.")
+
+    # Store every upload once, before the form's temporary files go away with this handler
+    names = await asyncio.gather(*(save_image(file) for file in files), return_exceptions=True)
+    stored = [
+        name if isinstance(name, Exception) else StoredInput(name, file.filename)
+        for name, file in zip(names, files)
+    ]
+    slots = asyncio.Semaphore(concurrency)
+    tasks = [
+        asyncio.create_task(run_batch_item(workflow, index, item, defaults, stored, slots))
+        for index, item in enumerate(items)
+    ]
+    return StreamingResponse(batch_results(tasks), media_type="application/x-ndjson")
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match uses the weak comparison: W/"x" matches "x"
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+
+def not_modified(request: Request, etag: str, last_modified: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if not if_modified_since:
+        return False
+    try:
+        return email.utils.parsedate_to_datetime(last_modified) <= email.utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
 
-    if not results:
-        raise HTTPException(status_code=404, detail="No images found for the given ID.")
+def immutable_file_response(request: Request, path: Path, media_type: Optional[str] = None, accel_path: Optional[str] = None):
+    """
+    Serves a file that never changes under its name: cacheable forever, 304 for a matching
+    If-None-Match/If-Modified-Since, Range requests, and zero-copy sending where the server
+    supports it. With `accel_path` the body is left to the fronting nginx (X-Accel-Redirect).
+    """
+    response = FileResponse(path, media_type=media_type, stat_result=path.stat(), headers={"Cache-Control": IMMUTABLE})
+    validators = {name: response.headers[name] for name in ("etag", "last-modified", "cache-control")}
+    if not_modified(request, validators["etag"], validators["last-modified"]):
+        return Response(status_code=304, headers=validators)
+    if accel_path:
+        return Response(media_type=response.media_type, headers={**validators, "X-Accel-Redirect": accel_path})
+    return response
+
+def stored_object_response(request: Request, storage, name: str):
+    """
+    A result in object storage: a redirect to a presigned URL (RESULTS_READ_MODE "redirect"), or
+    the object streamed through this replica with its validators and Range honoured ("proxy").
+    """
+    if RESULTS_READ_MODE == "redirect":
+        # No existence check: the store answers 404 for an unknown key. The same URL is handed
+        # out for a while, so the browser cache keeps working
+        return RedirectResponse(storage.presigned_url(name), status_code=307,
+                                headers={"Cache-Control": f"private, max-age={int(RESULTS_PRESIGN_EXPIRY / 2)}"})
+
+    head = storage.head(name)
+    if head is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    validators = {
+        "etag": head["ETag"],
+        "last-modified": email.utils.format_datetime(head["LastModified"].astimezone(timezone.utc), usegmt=True),
+        "cache-control": IMMUTABLE,
+    }
+    if not_modified(request, validators["etag"], validators["last-modified"]):
+        return Response(status_code=304, headers=validators)
+    headers = {**validators, "accept-ranges": "bytes"}
+    if request.method == "HEAD":
+        return Response(media_type=head["ContentType"], headers={**headers, "content-length": str(head["ContentLength"])})
+    byte_range = request.headers.get("range")
+    if byte_range and request.headers.get("if-range") not in (None, validators["etag"]):
+        byte_range = None
+    try:
+        stored = storage.get(name, byte_range)
+    except Exception as e:
+        if "InvalidRange" in str(e):
+            raise HTTPException(status_code=416, detail="Requested range not satisfiable.")
+        raise
+    headers["content-length"] = str(stored["ContentLength"])
+    if stored.get("ContentRange"):
+        headers["content-range"] = stored["ContentRange"]
+    return StreamingResponse(stored["Body"].iter_chunks(UPLOAD_CHUNK_SIZE), media_type=head["ContentType"],
+                             status_code=206 if stored.get("ContentRange") else 200, headers=headers)
+
+# A result file, or with w and/or fmt a copy at most w pixels wide in that format (png, webp or
+# jpeg), rendered once in the derivative worker pool and then served from the derivative cache
+@app.api_route("/results/{name}", methods=["GET", "HEAD"])
+async def get_result_file(
+    name: str,
+    request: Request,
+    w: Optional[int] = Query(None, ge=16, le=DERIVATIVE_MAX_WIDTH),
+    fmt: Optional[str] = None,
+):
+    if Path(name).name != name or name.startswith("."):
+        raise HTTPException(status_code=404, detail="Not Found")
+    storage = get_result_storage()
+    if w is None and fmt is None and storage.kind == "s3":
+        return await asyncio.to_thread(stored_object_response, request, storage, name)
+    if storage.kind == "local" and not result_file(name).is_file():
+        raise HTTPException(status_code=404, detail="Not Found")
+    if w is None and fmt is None:
+        source = result_file(name)
+        accel_path = None
+        if RESULTS_ACCEL_REDIRECT:
+            accel_path = RESULTS_ACCEL_REDIRECT.rstrip("/") + "/" + source.relative_to(RESULTS_PATH).as_posix()
+        return immutable_file_response(request, source, accel_path=accel_path)
+
+    fmt = (fmt or DERIVATIVE_FORMAT).lower()
+    fmt = "jpeg" if fmt == "jpg" else fmt
+    if fmt not in ENCODINGS:
+        raise HTTPException(status_code=400, detail=f"fmt must be one of {', '.join(ENCODINGS)}.")
+    try:
+        path = await get_derivative(name, w or DERIVATIVE_MAX_WIDTH, fmt)
+    except Exception as e:
+        if storage.kind == "s3" and not await asyncio.to_thread(storage.exists, name):
+            raise HTTPException(status_code=404, detail="Not Found")
+        logger.error(f"Error rendering derivative of {name}: {e}")
+        raise HTTPException(status_code=500, detail="Error rendering image.")
+    return immutable_file_response(request, path, media_type=ENCODINGS[fmt][2])
 
-    images = []
-    for row in results:
+# GET images by ID
+@app.get("/images/{id}")
+def get_images_by_id(id: int, request: Request):
+    # A result answered moments ago may still be waiting for the background writer
+    row = get_result_writer().get(id) or image_rows.get(id)
+    if row is None:
+        query = """
+            SELECT id, client_id, prompt_id, image_output_path, file_size, file_type, upload_time, workflow
+            FROM generated_images
+            WHERE id = %s
+        """
+        results = execute_query(query, (id,))
+        if not results:
+            raise HTTPException(status_code=404, detail="No images found for the given ID.")
+        row = results[0]
+        image_rows.put(id, row)
+
+    body = json.dumps(jsonable_encoder({
+        "success": True,
+        "images": [image_record(row)],
+        "message": "Images retrieved successfully.",
+    })).encode("utf-8")
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def image_record(row) -> dict:
+    return {
+        "id": row["id"],
+        "client_id": row["client_id"],
+        "prompt_id": row["prompt_id"],
+        "workflow": row["workflow"],
+        "file_size": row["file_size"],
+        "file_type": row["file_type"],
+        "upload_time": row["upload_time"],
         # Modify the image_output_path to use the server URL
-        image_url = f"http://{API_ADDRESS}/results/{Path(row['image_output_path']).name}"
-        images.append({
-            "id": row["id"],
-            "client_id": row["client_id"],
-            "prompt_id": row["prompt_id"],
-            "file_size": row["file_size"],
-            "file_type": row["file_type"],
-            "upload_time": row["upload_time"],
-            "image_url": image_url  # Use the modified URL
-        })
+        "image_url": f"http://{API_ADDRESS}/results/{result_name(row['image_output_path'])}",
+    }
 
-    return {"success": True, "images": images, "message": "Images retrieved successfully."}
+def encode_cursor(row) -> str:
+    key = json.dumps([row["upload_time"].isoformat(), row["id"]])
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
 
-# GET all images
+def decode_cursor(cursor: str):
+    try:
+        upload_time, id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(upload_time), int(id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+def image_list_stream(first, rows, limit):
+    # Writes the JSON body one row at a time; one row past `limit` only tells whether there is a next page
+    last = None
+    has_more = False
+    try:
+        yield '{"success": true, "images": ['
+        for count, row in enumerate(itertools.chain([first], rows)):
+            if count == limit:
+                has_more = True
+                break
+            yield ("," if count else "") + json.dumps(jsonable_encoder(image_record(row)))
+            last = row
+    except psycopg2.Error as e:
+        # The status line is already sent; end the document so the client sees a short page
+        logger.error(f"Database error while streaming images: {e}")
+    finally:
+        rows.close()
+    next_cursor = encode_cursor(last) if has_more else None
+    yield f'], "next_cursor": {json.dumps(next_cursor)}, "message": "Images retrieved successfully."}}'
+
+# GET images, newest first, in pages of `limit`; pass the returned next_cursor to get the next page
 @app.get("/images")
-def get_all_images():
-    query = """
-        SELECT id, prompt_id, client_id, image_output_path, file_size, file_type, upload_time
+def get_all_images(
+    client_id: Optional[uuid.UUID] = None,
+    prompt_id: Optional[uuid.UUID] = None,
+    workflow: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(IMAGE_LIST_DEFAULT_LIMIT, ge=1, le=IMAGE_LIST_MAX_LIMIT),
+):
+    conditions, params = [], []
+    for column, value in (("client_id", client_id), ("prompt_id", prompt_id), ("workflow", workflow)):
+        if value is not None:
+            conditions.append(f"{column} = %s")
+            params.append(str(value))
+    if since is not None:
+        conditions.append("upload_time >= %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("upload_time < %s")
+        params.append(until)
+    if cursor is not None:
+        # Keyset pagination: continue after the last row of the previous page, whatever its depth
+        conditions.append("(upload_time, id) < (%s, %s)")
+        params.extend(decode_cursor(cursor))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f"""
+        SELECT id, prompt_id, client_id, image_output_path, file_size, file_type, upload_time, workflow
         FROM generated_images
+        {where}
+        ORDER BY upload_time DESC, id DESC
+        LIMIT %s
     """
-    results = execute_query(query)
+    params.append(limit + 1)
 
-    if not results:
+    rows = stream_query(query, tuple(params), itersize=min(limit + 1, 500))
+    try:
+        first = next(rows, None)
+    except psycopg2.Error as e:
+        logger.error(f"Database error: {e}")
+        raise HTTPException(status_code=500, detail="Database error")
+    if first is None:
         raise HTTPException(status_code=404, detail="No images found.")
+    return StreamingResponse(image_list_stream(first, rows, limit), media_type="application/json")
 
-    images = []
-    for row in results:
-        # Modify the image_output_path to use the server URL
-        image_url = f"http://{API_ADDRESS}/results/{Path(row['image_output_path']).name}"
-        images.append({
-            "id": row["id"],
-            "prompt_id": row["prompt_id"],
-            "client_id": row["client_id"],
-            "file_size": row["file_size"],
-            "file_type": row["file_type"],
-            "upload_time": row["upload_time"],
-            "image_url": image_url  # Use the modified URL
-        })
+# Job status: queued/running/done/failed/cancelled plus node progress
+@app.get("/jobs/{job_id}")
+def get_job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return {"success": True, "job": job.to_dict()}
 
-    return {"success": True, "images": images, "message": "Images retrieved successfully."}
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def job_events(job, previews):
+    queue = job.subscribe(previews)
+    try:
+        yield sse("status", job.to_dict())
+        if job.status in FINISHED:
+            yield sse(job.status, job.to_dict())
+            return
+        idle = 0
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), JOB_QUEUE_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                # Nothing from ComfyUI: refresh the queue position while waiting, else keep the stream alive
+                idle += JOB_QUEUE_POLL_INTERVAL
+                prompt_id = job.prompt_id or ledger.prompt_id(job.id)
+                if job.status == QUEUED and prompt_id:
+                    job.set_queue_position(await get_queue_position(prompt_id))
+                if idle >= JOB_EVENT_HEARTBEAT:
+                    idle = 0
+                    yield ": keep-alive\n\n"
+                continue
+            idle = 0
+            if event == "preview":
+                encoded = base64.b64encode(data["image"]).decode("ascii")
+                data = {"node": data["node"], "image": f"data:image/{data['format']};base64,{encoded}"}
+            yield sse(event, data)
+            if event in FINISHED:
+                return
+    finally:
+        job.unsubscribe(queue)
+
+# Live progress of a job as Server-Sent Events: "status" (node, step/max, queue position),
+# "preview" (latent previews as data URLs, only with previews=true), then done/failed/cancelled
+@app.get("/jobs/{job_id}/events")
+def get_job_events(job_id: str, previews: bool = False):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return StreamingResponse(job_events(job, previews), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    if job.status == FAILED:
+        raise HTTPException(status_code=500, detail=f"Job failed: {job.error}")
+    if job.status == CANCELLED:
+        raise HTTPException(status_code=409, detail="Job was cancelled.")
+    if job.status != DONE:
+        return JSONResponse(status_code=202, content={"success": False, "job": job.to_dict(), "message": "Job not finished yet."})
+    return {"success": True, "job": job.to_dict(), "images": construct_image_response(job.rows)}
+
+@app.delete("/jobs/{job_id}")
+async def delete_job(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    job = await cancel_job(job)
+    return {"success": True, "job": job.to_dict()}
+
+# Submission counters: executions_per_request stays at 1.0 when nothing double-submits
+@app.get("/stats/submissions")
+def get_submission_stats():
+    return {"success": True, "stats": ledger.stats()}
+
+# Hit/miss/eviction counters of the deterministic result cache and of the GET /images/{id} row cache
+@app.get("/stats/result-cache")
+def get_result_cache_stats():
+    return {"success": True, "stats": result_cache.stats(), "image_rows": image_rows.stats()}
+
+# Files and bytes the retention/quota reaper deleted in its last run, and in total
+@app.get("/stats/reaper")
+def get_reaper_stats():
+    return {"success": True, "stats": reaper.stats()}
+
+# Size and hit rate of the on-disk thumbnail/derivative cache
+@app.get("/stats/derivatives")
+def get_derivative_stats():
+    return {"success": True, "stats": derivative_cache.stats()}
+
+# Database pool size, checkouts and wait times, for sizing DB_POOL_MAX under load,
+# and how many generated_images rows the background writer puts in each INSERT
+@app.get("/stats/db")
+def get_db_stats():
+    return {"success": True, "stats": get_db_pool().stats(), "writer": get_result_writer().stats()}
+
+# Health and load of each ComfyUI backend in the pool
+@app.get("/stats/backends")
+def get_backend_stats():
+    return {"success": True, "backends": get_pool().stats()}
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,53 @@
+import os
+import json
+import hashlib
+from lru import LRUCache
+from input_store import input_digest, input_dir
+from workflow_templates import get_template
+from settings import RESULT_CACHE_SIZE
+
+# Maps a deterministic request key to the generated_images rows it produced
+result_cache = LRUCache(RESULT_CACHE_SIZE)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def input_image_path(image):
+    # Handlers store either an absolute path or a name relative to the input folder
+    return image if os.path.isabs(image) else os.path.join(input_dir(), image)
+
+def cache_material(workflow, values):
+    """
+    Canonical description of a request: workflow id, graph digest and input size, normalized parameters
+    and the SHA-256 of every input image. The seed is left out so it can be derived from this.
+    """
+    template = get_template(workflow)
+    params = {}
+    for node_id, inputs in values.items():
+        for name, value in inputs.items():
+            if template.seed == (node_id, name):
+                continue
+            if name == "image":
+                # Stored inputs carry their content hash in the name; anything else is hashed
+                value = input_digest(value) or file_sha256(input_image_path(str(value)))
+            elif isinstance(value, float):
+                value = round(value, 6)
+            params[f"{node_id}.{name}"] = value
+    material = {"workflow": workflow, "graph": template.digest, "max_side": template.max_side, "params": params}
+    return json.dumps(material, sort_keys=True, separators=(",", ":"))
+
+def derive_seed(material):
+    # Same range as the random.randint seeds the handlers use
+    return int(hashlib.sha256(f"seed:{material}".encode("utf-8")).hexdigest(), 16) % 1000000000000000
+
+def cacheable(rows):
+    # Rows from get_prompt_images(keep_slots=True): cache only a run where ComfyUI reported outputs and
+    # every one of them was stored, so a failed fetch is retried by the next identical request
+    return bool(rows) and None not in rows
+
+def cache_key(material, seed):
+    return hashlib.sha256(f"{material}|{seed}".encode("utf-8")).hexdigest()
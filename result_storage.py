@@ -0,0 +1,169 @@
+import os
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from lru import LRUCache
+from output_store import result_file, result_relative_path
+from settings import (RESULT_STORAGE, RESULTS_S3_BUCKET, RESULTS_S3_PREFIX, RESULTS_S3_ENDPOINT, RESULTS_S3_REGION,
+                      RESULTS_PRESIGN_EXPIRY, S3_MULTIPART_THRESHOLD, S3_MULTIPART_CHUNK, S3_UPLOAD_WORKERS)
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:  # only needed with RESULT_STORAGE = "s3"
+    boto3 = None
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+class LocalStorage:
+    """Result files stay where output_store wrote them, under RESULTS_PATH."""
+
+    kind = "local"
+
+    def save(self, path: Path, mime):
+        pass
+
+    def release(self, path: Path):
+        pass
+
+    def exists(self, name):
+        return result_file(name).is_file()
+
+    @contextmanager
+    def local_copy(self, name):
+        yield result_file(name)
+
+    def delete(self, name):
+        result_file(name).unlink(missing_ok=True)
+
+class S3Storage:
+    """
+    Result files in an S3-compatible bucket (AWS, MinIO, ...), so API replicas need no shared disk.
+
+    output_store still writes each result to RESULTS_PATH first; `save` streams that file to the
+    bucket in S3_MULTIPART_CHUNK parts (a single PUT below S3_MULTIPART_THRESHOLD) and `release`
+    drops the local copy once the eager thumbnails are rendered from it. Objects are keyed like
+    the local layout, RESULTS_S3_PREFIX + "ab/cd/<name>".
+    """
+
+    kind = "s3"
+
+    def __init__(self, bucket=RESULTS_S3_BUCKET, prefix=RESULTS_S3_PREFIX, endpoint_url=RESULTS_S3_ENDPOINT,
+                 region=RESULTS_S3_REGION):
+        if boto3 is None:
+            raise RuntimeError('RESULT_STORAGE = "s3" needs boto3: pip install boto3')
+        if not bucket:
+            raise RuntimeError('RESULT_STORAGE = "s3" needs RESULTS_S3_BUCKET')
+        self.bucket = bucket
+        self.prefix = prefix
+        # Credentials come from the usual AWS environment variables or config files
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            config=Config(max_pool_connections=max(10, S3_UPLOAD_WORKERS * 4), signature_version="s3v4"),
+        )
+        self.transfer = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S3_MULTIPART_CHUNK,
+            use_threads=True,
+        )
+        # name -> presigned URL, reused for half its lifetime so browsers can cache what it points to
+        self.presigned = LRUCache(10000, ttl=RESULTS_PRESIGN_EXPIRY / 2)
+
+    def key(self, name):
+        return f"{self.prefix}{result_relative_path(name)}"
+
+    def save(self, path: Path, mime):
+        # upload_file reads the file part by part; it is never loaded into memory whole
+        self.client.upload_file(
+            str(path), self.bucket, self.key(path.name),
+            ExtraArgs={"ContentType": mime, "CacheControl": IMMUTABLE},
+            Config=self.transfer,
+        )
+
+    def release(self, path: Path):
+        path.unlink(missing_ok=True)
+
+    def head(self, name):
+        """Object metadata, or None if there is no such result."""
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def exists(self, name):
+        return self.head(name) is not None
+
+    def get(self, name, byte_range=None):
+        """get_object response; its Body streams the object (or `byte_range`, an HTTP Range value)."""
+        options = {"Range": byte_range} if byte_range else {}
+        return self.client.get_object(Bucket=self.bucket, Key=self.key(name), **options)
+
+    def presigned_url(self, name):
+        url = self.presigned.get(name)
+        if url is None:
+            url = self.client.generate_presigned_url(
+                "get_object", Params={"Bucket": self.bucket, "Key": self.key(name)}, ExpiresIn=RESULTS_PRESIGN_EXPIRY,
+            )
+            self.presigned.put(name, url)
+        return url
+
+    @contextmanager
+    def local_copy(self, name):
+        # Streamed to a temporary file, for the derivative renderer
+        fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(name)[1])
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self.key(name), tmp_path, Config=self.transfer)
+            yield Path(tmp_path)
+        finally:
+            os.unlink(tmp_path)
+
+    def delete(self, name):
+        self.presigned.pop(name)
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+STORAGES = {"local": LocalStorage, "s3": S3Storage}
+
+_storage = None
+_storage_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=S3_UPLOAD_WORKERS, thread_name_prefix="store")
+
+def get_result_storage():
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = STORAGES[RESULT_STORAGE]()
+    return _storage
+
+def _save_or_skip(storage, entry):
+    if entry is None:
+        return None
+    path, _, mime = entry
+    try:
+        storage.save(path, mime)
+        return entry
+    except Exception as e:
+        logger.error(f"Error storing result {path.name} in {storage.kind} storage: {e}")
+        storage.release(path)
+        return None
+
+def save_outputs(written):
+    """
+    Makes written (path, size, MIME type) results durable in the configured storage, in parallel.
+    Keeps the order of `written`, with None in place of results that could not be stored.
+    """
+    storage = get_result_storage()
+    if storage.kind == "local":
+        return written
+    return list(_executor.map(_save_or_skip, [storage] * len(written), written))
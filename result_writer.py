@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime
+from psycopg2.extras import execute_values
+from lru import LRUCache
+from db_pool import db_connection
+from settings import (RESULT_WRITE_INTERVAL, RESULT_WRITE_BATCH, RESULT_WRITE_RETRY_DELAY, RESULT_ID_BLOCK,
+                      RESULT_JOURNAL_PATH, RESULT_JOURNAL_FSYNC, IMAGE_ROW_CACHE_SIZE, IMAGE_ROW_CACHE_TTL)
+
+logger = logging.getLogger(__name__)
+
+# id -> generated_images row. Rows never change once written, so lookups by id are served from
+# here; the TTL only bounds how long a deleted row can still be seen
+image_rows = LRUCache(IMAGE_ROW_CACHE_SIZE, ttl=IMAGE_ROW_CACHE_TTL)
+
+COLUMNS = ("id", "client_id", "prompt_id", "image_output_path", "file_size", "file_type", "upload_time", "workflow")
+
+INSERT_QUERY = f"""
+    INSERT INTO generated_images ({", ".join(COLUMNS)})
+    VALUES %s
+    ON CONFLICT (id) DO NOTHING
+"""
+
+def _process_alive(pid):
+    if os.name == "nt":
+        # Windows refuses to delete a journal another process still has open, so adopting
+        # the segments of a live writer cannot lose rows there
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class ResultWriter:
+    """
+    Writes generated_images rows in the background, many requests per INSERT.
+
+    `submit` gives each row its id from a block reserved on the table's sequence, appends
+    it to a journal segment on local disk and returns at once; the writer thread inserts
+    everything pending every RESULT_WRITE_INTERVAL seconds, or as soon as RESULT_WRITE_BATCH
+    rows are waiting, and deletes the segments once their rows are committed. Segments left
+    behind by a process that died are replayed on start, and the insert ignores ids that
+    already exist, so a row is written exactly once however often it is replayed.
+    """
+
+    def __init__(self, journal_path=RESULT_JOURNAL_PATH):
+        self.journal_dir = Path(journal_path)
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.id_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = False
+        self.ids = []
+        # Rows not yet committed, by id, so a result can be read back before its batch lands
+        self.unwritten = {}
+        self.pending = []
+        self.segments = []
+        self.journal = None
+        self.journal_path = None
+        self.segment_number = 0
+        self.rows_written = 0
+        self.batches = 0
+        self.failures = 0
+        self.replayed = 0
+        self.last_batch_rows = 0
+        self.last_batch_ms = 0.0
+        self.thread = None
+
+    def reserve_ids(self, count):
+        with self.id_lock:
+            if len(self.ids) < count:
+                with db_connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute(
+                            "SELECT nextval(pg_get_serial_sequence('generated_images', 'id')) "
+                            "FROM generate_series(1, %s)",
+                            (max(count - len(self.ids), RESULT_ID_BLOCK),),
+                        )
+                        self.ids.extend(row[0] for row in cursor.fetchall())
+            reserved, self.ids = self.ids[:count], self.ids[count:]
+            return reserved
+
+    def submit(self, records):
+        """
+        Queues (client_id, prompt_id, image_output_path, file_size, file_type, upload_time, workflow)
+        records and returns their generated_images rows, ids included, once they are journaled.
+        """
+        rows = [dict(zip(COLUMNS, (id, *record))) for id, record in zip(self.reserve_ids(len(records)), records)]
+        lines = "".join(json.dumps({**row, "upload_time": row["upload_time"].isoformat()}) + "\n" for row in rows)
+        with self.lock:
+            if self.journal is None:
+                self.segment_number += 1
+                self.journal_path = self.journal_dir / f"{os.getpid()}-{self.segment_number}.jsonl"
+                self.journal = open(self.journal_path, "a", encoding="utf-8")
+            self.journal.write(lines)
+            self.journal.flush()
+            if RESULT_JOURNAL_FSYNC:
+                os.fsync(self.journal.fileno())
+            self.pending.extend(rows)
+            self.unwritten.update((row["id"], row) for row in rows)
+            if len(self.pending) >= RESULT_WRITE_BATCH:
+                self.wake.set()
+        return rows
+
+    def get(self, id):
+        with self.lock:
+            return self.unwritten.get(id)
+
+    def replay(self):
+        """Adopts journal segments of writers that are no longer running."""
+        for path in sorted(self.journal_dir.glob("*.jsonl")):
+            pid = int(path.name.split("-", 1)[0])
+            if pid != os.getpid() and _process_alive(pid):
+                continue
+            rows = []
+            for line in path.read_text(encoding="utf-8").splitlines():
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    # Torn last line of a process that died mid-write; its request never got an answer
+                    continue
+                row["upload_time"] = datetime.fromisoformat(row["upload_time"])
+                rows.append(row)
+            with self.lock:
+                self.pending.extend(rows)
+                self.segments.append(path)
+                self.unwritten.update((row["id"], row) for row in rows)
+            self.replayed += len(rows)
+            logger.info(f"Replaying {len(rows)} generated_images row(s) from {path}")
+
+    def _take(self):
+        with self.lock:
+            if self.journal is not None:
+                # Later submissions go to a new segment, so this one can be deleted once committed
+                self.journal.close()
+                self.segments.append(self.journal_path)
+                self.journal = None
+            rows, segments = self.pending, self.segments
+            self.pending, self.segments = [], []
+            return rows, segments
+
+    def flush(self):
+        """Inserts everything pending in one transaction. Returns False if the database refused it."""
+        rows, segments = self._take()
+        if not rows:
+            for path in segments:
+                path.unlink(missing_ok=True)
+            return True
+        start = time.monotonic()
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cursor:
+                    execute_values(cursor, INSERT_QUERY, [tuple(row[column] for column in COLUMNS) for row in rows],
+                                   page_size=RESULT_WRITE_BATCH)
+        except Exception as e:
+            logger.error(f"Writing {len(rows)} generated_images row(s) failed, will retry: {e}")
+            with self.lock:
+                self.pending = rows + self.pending
+                self.segments = segments + self.segments
+                self.failures += 1
+            return False
+        for path in segments:
+            try:
+                path.unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning(f"Could not remove journal segment {path}: {e}")
+        with self.lock:
+            for row in rows:
+                # Freshly written results are the ones clients poll for next
+                image_rows.put(row["id"], row)
+                self.unwritten.pop(row["id"], None)
+            self.rows_written += len(rows)
+            self.batches += 1
+            self.last_batch_rows = len(rows)
+            self.last_batch_ms = round((time.monotonic() - start) * 1000, 3)
+        return True
+
+    def _run(self):
+        while not self.stopping:
+            self.wake.wait(RESULT_WRITE_INTERVAL)
+            self.wake.clear()
+            if not self.flush():
+                time.sleep(RESULT_WRITE_RETRY_DELAY)
+
+    def start(self):
+        self.replay()
+        self.thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the thread and writes what is left; rows the database refuses stay journaled for the next start."""
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+        if not self.flush():
+            logger.error(f"{len(self.pending)} generated_images row(s) left in {self.journal_dir} for the next start")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "unwritten": len(self.unwritten),
+                "rows_written": self.rows_written,
+                "batches": self.batches,
+                "rows_per_batch": round(self.rows_written / self.batches, 2) if self.batches else 0,
+                "last_batch_rows": self.last_batch_rows,
+                "last_batch_ms": self.last_batch_ms,
+                "failures": self.failures,
+                "replayed": self.replayed,
+            }
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def init_result_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = ResultWriter()
+            _writer.start()
+            # The Gradio apps have no shutdown hook of their own
+            atexit.register(close_result_writer)
+    return _writer
+
+def get_result_writer():
+    return _writer or init_result_writer()
+
+def close_result_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.stop()
+        _writer = None
@@ -5,7 +5,7 @@ RESULTS_PATH = "C:/Users/midory/ComfyUI-API/results"
 CLOTH_SWAP_WORKFLOW = "workflow/Clothes_Swapping.json"
 EXPRESSION_WORKFLOW = "workflow/Simple_Expression.json"
 CLOTH_BACKGROUND_WORKFLOW = "workflow/Clothes_Background.json"
-HAIR_WORKFLOW = "workflow/hair.json"
+HAIR_WORKFLOW = "workflow/Hair.json"
 MAKEUP_WORKFLOW="workflow/makeup.json"
 EYEDETAILS_WORKFLOW="workflow/eye_details.json"
 EYE_LIP_FACE_WORKFLOW="workflow/eye_lip_face.json"
@@ -14,3 +14,118 @@ DB_NAME = "comfyui"
 DB_USER = "postgres"
 DB_HOST = "localhost"
 DB_PORT = "5432"
+SUBMISSION_LEDGER_SIZE = 10000
+JOB_RETENTION = 1000
+# ComfyUI servers the API load-balances across; add more "host:port" entries to scale out
+COMFY_BACKENDS = [SERVER_ADDRESS]
+BACKEND_HEALTH_INTERVAL = 5
+BACKEND_HEALTH_TIMEOUT = 3
+BACKEND_FAILURE_THRESHOLD = 3
+# Prompts waiting on a backend fail once its event WebSocket has been down for this many tries in a row (the close
+# and the failed reconnects after it, about 1.5s with the doubling backoff), or when the pool ejects it meanwhile
+DISPATCHER_RECONNECT_ATTEMPTS = 3
+TEMPLATE_RELOAD_CHECK_INTERVAL = 1
+RESULT_CACHE_SIZE = 5000
+# How input images reach ComfyUI: "local" writes them straight into COMFY_UI_PATH/input (API and
+# ComfyUI on the same host, nothing is copied for SERVER_ADDRESS; other COMFY_BACKENDS still get
+# uploads), "upload" stages them in INPUT_STAGING_PATH and posts them to the chosen backend's
+# /upload/image. Either way files a backend already has are skipped
+INPUT_TRANSPORT = "local"
+INPUT_STAGING_PATH = "inputs"
+UPLOADED_INPUTS_PER_BACKEND = 10000
+# Limits on each uploaded input image; bigger or non-image uploads are rejected while streaming
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+MAX_IMAGE_PIXELS = 40000000
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Worker processes that EXIF-rotate, downscale and re-encode inputs before they reach ComfyUI
+PREPROCESS_WORKERS = 2
+PREPARED_INPUTS_CACHE_SIZE = 10000
+# Encoding of result images: OUTPUT_FORMATS maps a workflow name to its own format, anything else
+# uses OUTPUT_FORMAT. {"format": "png", "compress_level": 0-9} is lossless, level 3 costs about a
+# third less CPU than Pillow's default 6 for ~10% larger files; {"format": "webp", "quality": 0-100}
+# or {"format": "webp", "lossless": True}; {"format": "jpeg", "quality": 0-100}
+OUTPUT_FORMAT = {"format": "png", "compress_level": 3}
+OUTPUT_FORMATS = {}
+OUTPUT_ENCODE_WORKERS = 4
+# How results come back from ComfyUI: "local" links the files the ComfyUI at SERVER_ADDRESS wrote
+# under COMFY_UI_PATH into RESULTS_PATH, "http" downloads them through /view (other backends in
+# COMFY_BACKENDS are always downloaded), "websocket" rewrites the templates' save nodes to
+# SaveImageWebsocket so images arrive over the event socket with no /history or /view calls
+# and no files left in ComfyUI's output folder.
+OUTPUT_TRANSPORT = "local"
+# Parallel /view downloads of the Gradio apps' (sync client's) outputs, each over its own keep-alive connection
+OUTPUT_DOWNLOAD_WORKERS = 4
+# Progress streams (/jobs/{id}/events): buffered updates per client, /queue poll interval while a job
+# waits, and the idle keep-alive interval
+JOB_EVENT_QUEUE_SIZE = 100
+JOB_QUEUE_POLL_INTERVAL = 1
+JOB_EVENT_HEARTBEAT = 15
+# PostgreSQL connection pool shared by the API handlers and the result writer
+DB_POOL_MIN = 1
+DB_POOL_MAX = 10
+DB_POOL_TIMEOUT = 10
+DB_POOL_HEALTH_CHECK_IDLE = 30
+# GET /images page size (limit query parameter) default and cap
+IMAGE_LIST_DEFAULT_LIMIT = 100
+IMAGE_LIST_MAX_LIMIT = 1000
+# Background writer for generated_images: rows are journaled under RESULT_JOURNAL_PATH and inserted
+# together every RESULT_WRITE_INTERVAL seconds, or as soon as RESULT_WRITE_BATCH rows are waiting
+RESULT_WRITE_INTERVAL = 0.05
+RESULT_WRITE_BATCH = 500
+RESULT_WRITE_RETRY_DELAY = 1
+RESULT_ID_BLOCK = 100
+RESULT_JOURNAL_PATH = "journal"
+RESULT_JOURNAL_FSYNC = True
+# GET /images/{id} row cache: entries kept and seconds before a row is read from Postgres again
+IMAGE_ROW_CACHE_SIZE = 20000
+IMAGE_ROW_CACHE_TTL = 3600
+# Resized copies served by GET /results/{name}?w=<width>&fmt=<png|webp|jpeg>: kept under DERIVATIVES_PATH
+# up to DERIVATIVE_CACHE_BYTES (least recently used evicted first). EAGER_THUMBNAIL_WIDTHS, e.g. (256,),
+# are rendered in DERIVATIVE_FORMAT as soon as a result is saved.
+DERIVATIVES_PATH = "derivatives"
+DERIVATIVE_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+DERIVATIVE_WORKERS = 2
+DERIVATIVE_FORMAT = "webp"
+DERIVATIVE_QUALITY = 80
+DERIVATIVE_MAX_WIDTH = 2048
+EAGER_THUMBNAIL_WIDTHS = ()
+# Internal nginx location mapped to RESULTS_PATH (e.g. "/_results/" with `internal; alias <RESULTS_PATH>/;`).
+# When set, GET /results/{name} answers with X-Accel-Redirect and nginx sends the file with sendfile.
+RESULTS_ACCEL_REDIRECT = None
+# Where result files are kept: "local" (RESULTS_PATH on this host) or "s3" (an S3-compatible bucket,
+# needs boto3; credentials from the AWS environment variables). With s3, GET /results/{name} either
+# redirects to a presigned URL ("redirect") or streams the object through the API ("proxy").
+RESULT_STORAGE = "local"
+RESULTS_S3_BUCKET = ""
+RESULTS_S3_PREFIX = "results/"
+RESULTS_S3_ENDPOINT = None  # e.g. "http://127.0.0.1:9000" for MinIO
+RESULTS_S3_REGION = None
+RESULTS_READ_MODE = "redirect"
+RESULTS_PRESIGN_EXPIRY = 3600
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+S3_MULTIPART_CHUNK = 8 * 1024 * 1024
+S3_UPLOAD_WORKERS = 4
+# Reaper: every REAPER_INTERVAL seconds, deletes stored inputs, files in COMFY_UI_PATH/output and results
+# (rows and files) older than the *_RETENTION age in seconds, then the least recently used (results: the
+# oldest) until the rest fit in *_QUOTA_BYTES; None disables a policy. Nothing younger than REAPER_MIN_AGE is touched.
+# Only files the API wrote are candidates: content-addressed inputs, and outputs named after the filename_prefix
+# of a registered template's save node. The output policy is off by default, as Clothes_Background.json saves
+# under ComfyUI's default "ComfyUI" prefix, which images saved by hand from the ComfyUI UI share.
+REAPER_INTERVAL = 3600
+REAPER_MIN_AGE = 3600
+REAPER_BATCH = 1000
+INPUT_RETENTION = 7 * 24 * 3600
+INPUT_QUOTA_BYTES = None
+COMFY_OUTPUT_RETENTION = None
+COMFY_OUTPUT_QUOTA_BYTES = None
+RESULT_RETENTION = None
+RESULTS_QUOTA_BYTES = None
+# Batches (POST /batch/{workflow}): items run BATCH_CONCURRENCY at a time unless the request asks for
+# another ?concurrency (up to BATCH_MAX_CONCURRENCY). BATCH_MAX_FILES stays below the 1000 files a
+# multipart form may carry.
+BATCH_CONCURRENCY = 4
+BATCH_MAX_CONCURRENCY = 16
+BATCH_MAX_ITEMS = 1000
+BATCH_MAX_FILES = 200
+# Most variants (combinations of swept values) one sweep request may run in its branched prompt
+SWEEP_MAX_VARIANTS = 64
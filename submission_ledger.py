@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+from settings import SUBMISSION_LEDGER_SIZE
+
+class SubmissionLedger:
+    """
+    Records which ComfyUI prompt_id was queued for each API request.
+
+    A request id can claim a submission exactly once; any further attempt for the same
+    request is refused and counted, so `duplicates_blocked` shows whether some code path
+    still tries to run a graph twice. Thread-safe so the Gradio apps can share it.
+    """
+
+    def __init__(self, max_entries=SUBMISSION_LEDGER_SIZE):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.requests = 0
+        self.submissions = 0
+        self.duplicates_blocked = 0
+
+    def claim(self, request_id):
+        """Returns (True, None) for the first claim, otherwise (False, prompt_id or None if still in flight)."""
+        with self.lock:
+            if request_id in self.entries:
+                self.duplicates_blocked += 1
+                return False, self.entries[request_id]
+            self.entries[request_id] = None
+            self.requests += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return True, None
+
+    def record(self, request_id, prompt_id):
+        with self.lock:
+            self.entries[request_id] = prompt_id
+            self.submissions += 1
+
+    def release(self, request_id):
+        # The submission failed before ComfyUI accepted it, so the request may try again
+        with self.lock:
+            if self.entries.get(request_id, "") is None:
+                del self.entries[request_id]
+                self.requests -= 1
+
+    def prompt_id(self, request_id):
+        with self.lock:
+            return self.entries.get(request_id)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "submissions": self.submissions,
+                "duplicates_blocked": self.duplicates_blocked,
+                "executions_per_request": round(self.submissions / self.requests, 3) if self.requests else 0,
+            }
+
+ledger = SubmissionLedger()
@@ -0,0 +1,110 @@
+import uuid
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+class FakeComfy:
+    """
+    A stand-in ComfyUI server on a local port: /prompt, /ws events, /history, /view, /queue and
+    /system_stats. Every SaveImage node of a prompt yields one output whose bytes name the server,
+    so tests can tell which backend an image came from.
+    """
+
+    def __init__(self, name, queue_depth=0, vram_free=1000):
+        self.name = name
+        self.queue_depth = queue_depth
+        self.vram_free = vram_free
+        # False holds prompts running until the server goes away; "error" answers /prompt with a 500
+        self.finish = True
+        self.prompt_mode = "ok"
+        self.requests = []
+        self.prompts = {}
+        self.history = {}
+        self.sockets = []
+        self.server = None
+        self.port = None
+
+    @property
+    def address(self):
+        return f"127.0.0.1:{self.port}"
+
+    def paths(self, prefix):
+        return [path for path in self.requests if path.startswith(prefix)]
+
+    async def start(self):
+        app = web.Application()
+        app.middlewares.append(self.log)
+        app.router.add_get("/ws", self.ws)
+        app.router.add_post("/prompt", self.prompt)
+        app.router.add_get("/history/{prompt_id}", self.get_history)
+        app.router.add_get("/view", self.view)
+        app.router.add_get("/queue", self.queue)
+        app.router.add_get("/system_stats", self.system_stats)
+        # A restarted server comes back on the port it had
+        self.server = TestServer(app, host="127.0.0.1", port=self.port)
+        await self.server.start_server()
+        self.port = self.server.port
+
+    async def stop(self):
+        if self.server is None:
+            return
+        for ws in self.sockets:
+            await ws.close()
+        self.sockets.clear()
+        await self.server.close()
+        self.server = None
+
+    @web.middleware
+    async def log(self, request, handler):
+        self.requests.append(request.path)
+        return await handler(request)
+
+    async def ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.append(ws)
+        await ws.send_json({"type": "status", "data": {"status": {}}})
+        async for _ in ws:
+            pass
+        return ws
+
+    async def prompt(self, request):
+        if self.prompt_mode == "error":
+            raise RuntimeError("backend broken")
+        body = await request.json()
+        prompt_id = str(uuid.uuid4())
+        self.prompts[prompt_id] = body["prompt"]
+        asyncio.get_running_loop().create_task(self.run(prompt_id, body["prompt"]))
+        return web.json_response({"prompt_id": prompt_id, "number": len(self.prompts), "node_errors": {}})
+
+    async def send(self, message):
+        for ws in self.sockets:
+            if not ws.closed:
+                await ws.send_json(message)
+
+    async def run(self, prompt_id, prompt):
+        await asyncio.sleep(0.05)
+        await self.send({"type": "execution_start", "data": {"prompt_id": prompt_id}})
+        outputs = {}
+        for node_id, node in prompt.items():
+            await self.send({"type": "executing", "data": {"node": node_id, "prompt_id": prompt_id}})
+            if node["class_type"] == "SaveImage":
+                outputs[node_id] = {"images": [{"filename": f"{prompt_id}_{node_id}.png", "subfolder": "", "type": "output"}]}
+        if not self.finish:
+            return
+        self.history[prompt_id] = {"outputs": outputs, "status": {"status_str": "success"}}
+        await self.send({"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+
+    async def get_history(self, request):
+        prompt_id = request.match_info["prompt_id"]
+        return web.json_response({prompt_id: self.history[prompt_id]} if prompt_id in self.history else {})
+
+    async def view(self, request):
+        return web.Response(body=f"{self.name}:{request.query['filename']}".encode(), content_type="image/png")
+
+    async def queue(self, request):
+        pending = [[number, str(uuid.uuid4()), {}, {}, []] for number in range(self.queue_depth)]
+        return web.json_response({"queue_running": [], "queue_pending": pending})
+
+    async def system_stats(self, request):
+        return web.json_response({"devices": [{"vram_free": self.vram_free}]})
@@ -0,0 +1,166 @@
+import uuid
+import asyncio
+import pytest
+import async_websockets_api as api
+from settings import BACKEND_FAILURE_THRESHOLD
+from fake_comfy import FakeComfy
+
+PROMPT = {
+    "1": {"class_type": "LoadImage", "inputs": {}},
+    "2": {"class_type": "SaveImage", "inputs": {"images": ["1", 0]}},
+    "3": {"class_type": "SaveImage", "inputs": {"images": ["1", 0]}},
+}
+
+async def start_pool(monkeypatch, *fakes):
+    for fake in fakes:
+        await fake.start()
+    monkeypatch.setattr(api, "COMFY_BACKENDS", [fake.address for fake in fakes])
+    await api.start_event_listener()
+    return api.get_pool()
+
+async def stop_pool(*fakes):
+    await api.stop_event_listener()
+    await api.close_session()
+    for fake in fakes:
+        await fake.stop()
+
+def backend_of(pool, fake):
+    return next(backend for backend in pool.backends if backend.address == fake.address)
+
+def run(scenario, monkeypatch, *fakes):
+    async def main():
+        pool = await start_pool(monkeypatch, *fakes)
+        try:
+            await scenario(pool)
+        finally:
+            await stop_pool(*fakes)
+    asyncio.run(main())
+
+def test_routes_to_least_loaded_backend(monkeypatch):
+    busy, idle = FakeComfy("busy", queue_depth=3), FakeComfy("idle", queue_depth=0)
+
+    async def scenario(pool):
+        prompt_id, backend = await api.submit_prompt(PROMPT, str(uuid.uuid4()))
+        assert backend.address == idle.address
+        assert prompt_id in idle.prompts and not busy.prompts
+        assert pool.backend_for(prompt_id) is backend
+
+    run(scenario, monkeypatch, busy, idle)
+
+def test_concurrent_acquires_spread_across_backends(monkeypatch):
+    first, second = FakeComfy("first"), FakeComfy("second")
+
+    async def scenario(pool):
+        chosen = [pool.acquire() for _ in range(4)]
+        assert [backend.assigned for backend in pool.backends] == [2, 2]
+        for backend in chosen:
+            pool.release(backend)
+        assert [backend.assigned for backend in pool.backends] == [0, 0]
+
+    run(scenario, monkeypatch, first, second)
+
+def test_free_vram_breaks_ties(monkeypatch):
+    small, large = FakeComfy("small", vram_free=10), FakeComfy("large", vram_free=5000)
+
+    async def scenario(pool):
+        assert pool.acquire().address == large.address
+
+    run(scenario, monkeypatch, small, large)
+
+def test_ejects_failing_backend_and_readds_it_after_a_good_check(monkeypatch):
+    stable, flaky = FakeComfy("stable", queue_depth=2), FakeComfy("flaky")
+
+    async def scenario(pool):
+        backend = backend_of(pool, flaky)
+        await flaky.stop()
+        while backend.healthy:
+            await pool.check(backend)
+        assert backend.failures == BACKEND_FAILURE_THRESHOLD
+        assert not backend.healthy
+        _, chosen = await api.submit_prompt(PROMPT, str(uuid.uuid4()))
+        assert chosen.address == stable.address
+
+        await flaky.start()
+        await pool.check(backend)
+        assert backend.healthy and backend.failures == 0
+        await asyncio.wait_for(backend.dispatcher.connected.wait(), 10)
+        _, chosen = await api.submit_prompt(PROMPT, str(uuid.uuid4()))
+        assert chosen.address == flaky.address
+
+    run(scenario, monkeypatch, stable, flaky)
+
+def test_fails_over_when_submission_fails(monkeypatch):
+    broken, spare = FakeComfy("broken"), FakeComfy("spare", queue_depth=5)
+    broken.prompt_mode = "error"
+
+    async def scenario(pool):
+        prompt_id, backend = await api.submit_prompt(PROMPT, str(uuid.uuid4()))
+        assert backend.address == spare.address and prompt_id in spare.prompts
+        failed = backend_of(pool, broken)
+        assert failed.failures == 1 and failed.assigned == 0
+        assert broken.paths("/prompt")
+
+    run(scenario, monkeypatch, broken, spare)
+
+def test_raises_when_no_backend_accepts(monkeypatch):
+    broken = FakeComfy("broken")
+    broken.prompt_mode = "error"
+
+    async def scenario(pool):
+        with pytest.raises(RuntimeError, match="No healthy ComfyUI backend"):
+            await api.submit_prompt(PROMPT, str(uuid.uuid4()))
+
+    run(scenario, monkeypatch, broken)
+
+def test_reads_history_and_outputs_from_the_backend_that_ran_the_prompt(monkeypatch):
+    other, runner = FakeComfy("other", queue_depth=4), FakeComfy("runner")
+
+    async def scenario(pool):
+        prompt_id, backend, files, received = await api.get_outputs(PROMPT, str(uuid.uuid4()))
+        assert backend.address == runner.address and not received
+        assert [image["filename"] for image in files] == [f"{prompt_id}_2.png", f"{prompt_id}_3.png"]
+        data = await api.fetch_outputs(files, backend)
+        assert data == [f"runner:{image['filename']}".encode() for image in files]
+        assert runner.paths("/history") and len(runner.paths("/view")) == 2
+        assert not other.paths("/history") and not other.paths("/view")
+        assert backend.assigned == 0
+
+    run(scenario, monkeypatch, other, runner)
+
+def test_prompt_on_a_backend_that_dies_fails_instead_of_hanging(monkeypatch):
+    dying = FakeComfy("dying")
+    dying.finish = False
+
+    async def scenario(pool):
+        task = asyncio.create_task(api.get_outputs(PROMPT, str(uuid.uuid4())))
+        while not dying.paths("/prompt"):
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+        await dying.stop()
+        with pytest.raises(RuntimeError, match="Lost the connection"):
+            await asyncio.wait_for(task, 10)
+        assert pool.backends[0].assigned == 0
+
+    run(scenario, monkeypatch, dying)
+
+def test_ejecting_a_backend_fails_its_waiting_prompts(monkeypatch):
+    monkeypatch.setattr(api, "DISPATCHER_RECONNECT_ATTEMPTS", 1000)
+    dying = FakeComfy("dying")
+    dying.finish = False
+
+    async def scenario(pool):
+        task = asyncio.create_task(api.get_outputs(PROMPT, str(uuid.uuid4())))
+        while not dying.paths("/prompt"):
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+        await dying.stop()
+        backend = pool.backends[0]
+        while backend.healthy:
+            await pool.check(backend)
+        with pytest.raises(RuntimeError, match="ejected"):
+            await asyncio.wait_for(task, 5)
+        # Prompts watched before the socket comes back fail at once too
+        with pytest.raises(RuntimeError, match="ejected"):
+            await asyncio.wait_for(api.wait_for_prompt("late", backend.dispatcher), 1)
+
+    run(scenario, monkeypatch, dying)
@@ -0,0 +1,151 @@
+import os
+import uuid
+import urllib.request
+import pytest
+from fastapi.testclient import TestClient
+
+pytest.importorskip("boto3")
+moto_server = pytest.importorskip("moto.server")
+
+import reaper
+import restful_api
+import result_storage
+from output_store import result_relative_path
+from result_storage import S3Storage
+
+MiB = 1024 * 1024
+
+@pytest.fixture(scope="module")
+def s3_endpoint():
+    # moto's standalone server speaks the S3 HTTP API on a local port, like a MinIO stand-in
+    with pytest.MonkeyPatch.context() as env:
+        env.setenv("AWS_ACCESS_KEY_ID", "test")
+        env.setenv("AWS_SECRET_ACCESS_KEY", "test")
+        env.setenv("AWS_DEFAULT_REGION", "us-east-1")
+        server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+        server.start()
+        host, port = server.get_host_and_port()
+        try:
+            yield f"http://{host}:{port}"
+        finally:
+            server.stop()
+
+@pytest.fixture
+def storage(s3_endpoint, monkeypatch):
+    # S3 only accepts parts of 5 MiB or more, so that is the smallest threshold that can be tested
+    monkeypatch.setattr(result_storage, "S3_MULTIPART_THRESHOLD", 5 * MiB)
+    monkeypatch.setattr(result_storage, "S3_MULTIPART_CHUNK", 5 * MiB)
+    bucket = f"results-{uuid.uuid4().hex[:12]}"
+    storage = S3Storage(bucket=bucket, prefix="results/", endpoint_url=s3_endpoint, region="us-east-1")
+    storage.client.create_bucket(Bucket=bucket)
+    monkeypatch.setattr(result_storage, "_storage", storage)
+    return storage
+
+@pytest.fixture
+def client():
+    return TestClient(restful_api.app)
+
+def result(tmp_path, size):
+    path = tmp_path / f"result_{uuid.uuid4().hex}.png"
+    path.write_bytes(os.urandom(size))
+    return path
+
+def parts(storage, path):
+    # S3 ETags of multipart objects end in "-<number of parts>"
+    etag = storage.head(path.name)["ETag"].strip('"')
+    return int(etag.rsplit("-", 1)[1]) if "-" in etag else 1
+
+def test_small_result_is_a_single_put(storage, tmp_path):
+    path = result(tmp_path, 5 * MiB - 1)
+    storage.save(path, "image/png")
+    assert parts(storage, path) == 1
+    head = storage.head(path.name)
+    assert head["ContentLength"] == 5 * MiB - 1
+    assert head["ContentType"] == "image/png"
+    assert head["CacheControl"] == result_storage.IMMUTABLE
+
+def test_large_result_is_uploaded_in_parts(storage, tmp_path):
+    path = result(tmp_path, 11 * MiB)
+    storage.save(path, "image/png")
+    assert parts(storage, path) == 3
+    assert storage.get(path.name)["Body"].read() == path.read_bytes()
+
+def test_objects_are_keyed_like_the_local_layout(storage, tmp_path):
+    path = result(tmp_path, 100)
+    storage.save(path, "image/png")
+    listed = storage.client.list_objects_v2(Bucket=storage.bucket)["Contents"]
+    assert [item["Key"] for item in listed] == [f"results/{result_relative_path(path.name)}"]
+
+def test_release_drops_the_local_copy(storage, tmp_path):
+    path = result(tmp_path, 100)
+    storage.save(path, "image/png")
+    storage.release(path)
+    assert not path.exists()
+    assert storage.exists(path.name)
+    with storage.local_copy(path.name) as copy:
+        assert copy.read_bytes() == storage.get(path.name)["Body"].read()
+    assert not copy.exists()
+
+def test_save_outputs_keeps_slots_and_releases_failures(storage, tmp_path):
+    stored, missing = result(tmp_path, 100), tmp_path / "result_missing.png"
+    written = [(stored, 100, "image/png"), None, (missing, 100, "image/png")]
+    assert result_storage.save_outputs(written) == [written[0], None, None]
+    assert storage.exists(stored.name) and not storage.exists(missing.name)
+
+def test_redirect_mode_hands_out_a_cached_presigned_url(storage, tmp_path, client, monkeypatch):
+    monkeypatch.setattr(restful_api, "RESULTS_READ_MODE", "redirect")
+    path = result(tmp_path, 1000)
+    storage.save(path, "image/png")
+    first = client.get(f"/results/{path.name}", follow_redirects=False)
+    second = client.get(f"/results/{path.name}", follow_redirects=False)
+    assert first.status_code == 307
+    assert first.headers["location"] == second.headers["location"]
+    assert first.headers["cache-control"].startswith("private, max-age=")
+    with urllib.request.urlopen(first.headers["location"]) as response:
+        assert response.read() == path.read_bytes()
+
+def test_proxy_mode_streams_with_validators(storage, tmp_path, client, monkeypatch):
+    monkeypatch.setattr(restful_api, "RESULTS_READ_MODE", "proxy")
+    path = result(tmp_path, 1000)
+    storage.save(path, "image/png")
+    response = client.get(f"/results/{path.name}")
+    assert response.status_code == 200
+    assert response.content == path.read_bytes()
+    assert response.headers["content-type"] == "image/png"
+    assert response.headers["cache-control"] == result_storage.IMMUTABLE
+    assert response.headers["accept-ranges"] == "bytes"
+
+    head = client.head(f"/results/{path.name}")
+    assert head.status_code == 200 and head.headers["content-length"] == "1000"
+    assert client.get("/results/result_unknown.png").status_code == 404
+
+def test_proxy_mode_answers_if_none_match_with_304(storage, tmp_path, client, monkeypatch):
+    monkeypatch.setattr(restful_api, "RESULTS_READ_MODE", "proxy")
+    path = result(tmp_path, 1000)
+    storage.save(path, "image/png")
+    etag = client.get(f"/results/{path.name}").headers["etag"]
+    response = client.get(f"/results/{path.name}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag and not response.content
+
+def test_proxy_mode_serves_ranges(storage, tmp_path, client, monkeypatch):
+    monkeypatch.setattr(restful_api, "RESULTS_READ_MODE", "proxy")
+    path = result(tmp_path, 1000)
+    storage.save(path, "image/png")
+    response = client.get(f"/results/{path.name}", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 10-19/1000"
+    assert response.content == path.read_bytes()[10:20]
+    # A Range for another version of the object is ignored
+    stale = client.get(f"/results/{path.name}", headers={"Range": "bytes=10-19", "If-Range": '"stale"'})
+    assert stale.status_code == 200 and len(stale.content) == 1000
+
+def test_reaper_deletes_results_from_the_bucket(storage, tmp_path):
+    kept, reaped = result(tmp_path, 100), result(tmp_path, 100)
+    for path in (kept, reaped):
+        storage.save(path, "image/png")
+    storage.presigned_url(reaped.name)
+    reaper._forget_results([(1, result_relative_path(reaped.name), 100)])
+    assert not storage.exists(reaped.name)
+    assert storage.exists(kept.name)
+    assert storage.presigned.get(reaped.name) is None
@@ -1,41 +1,130 @@
 import io
 import json
+import threading
+import http.client
+import urllib.error
 import urllib.parse
 import urllib.request
 import uuid
-from pathlib import Path
 import websocket
-import psycopg2
-from psycopg2.extras import execute_values 
 from PIL import Image
+from pathlib import Path
 from datetime import datetime
-from db_config import DB_CONFIG
-from settings import SERVER_ADDRESS, RESULTS_PATH
+from concurrent.futures import ThreadPoolExecutor
+from result_writer import get_result_writer
+from derivatives import schedule_thumbnails
+from result_storage import get_result_storage, save_outputs
+from settings import (SERVER_ADDRESS, INPUT_TRANSPORT, OUTPUT_TRANSPORT, UPLOADED_INPUTS_PER_BACKEND, UPLOAD_CHUNK_SIZE,
+                      OUTPUT_DOWNLOAD_WORKERS)
+from submission_ledger import ledger
+from input_store import input_dir, prompt_inputs
+from lru import LRUCache
+from output_store import write_outputs, output_format, result_relative_path, local_output_path
+from workflow_templates import WEBSOCKET_SAVE_NODE
 
 client_id = str(uuid.uuid4())
+# Stored input names SERVER_ADDRESS is known to have (upload transport)
+uploaded_inputs = LRUCache(UPLOADED_INPUTS_PER_BACKEND)
+# Outputs are downloaded in parallel, each thread over its own keep-alive connection to /view
+_downloads = ThreadPoolExecutor(max_workers=OUTPUT_DOWNLOAD_WORKERS, thread_name_prefix="view")
+_view_connections = threading.local()
+
+def queue_prompt(prompt, request_id):
+    # The ledger guarantees at most one ComfyUI execution per request; callers make the id once per request
+    first, prompt_id = ledger.claim(request_id)
+    if not first:
+        print(f"Refusing duplicate submission for request {request_id}")
+        return {"prompt_id": prompt_id} if prompt_id else {}
 
-def queue_prompt(prompt):
     p = {"prompt": prompt, "client_id": client_id}
     data = json.dumps(p).encode("utf-8")
     req = urllib.request.Request(f"http://{SERVER_ADDRESS}/prompt", data=data)
     try:
         response = urllib.request.urlopen(req)
-        return json.loads(response.read())
+        result = json.loads(response.read())
     except Exception as e:
         print(f"Error queuing prompt: {e}")
-        return {}
+        result = {}
+    if result.get("prompt_id"):
+        ledger.record(request_id, result["prompt_id"])
+    else:
+        ledger.release(request_id)
+    return result
+
+def has_input(name):
+    url_values = urllib.parse.urlencode({"filename": name, "type": "input"})
+    req = urllib.request.Request(f"http://{SERVER_ADDRESS}/view?{url_values}", method="HEAD")
+    try:
+        with urllib.request.urlopen(req):
+            return True
+    except urllib.error.HTTPError:
+        return False
+
+def upload_input(name):
+    # The multipart body is sent from the file in UPLOAD_CHUNK_SIZE pieces, never held in memory whole
+    boundary = uuid.uuid4().hex
+    path = input_dir() / name
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="{name}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n").encode("utf-8")
+    tail = (f'\r\n--{boundary}\r\nContent-Disposition: form-data; name="type"\r\n\r\ninput\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="overwrite"\r\n\r\ntrue\r\n'
+            f"--{boundary}--\r\n").encode("utf-8")
+
+    def body():
+        yield head
+        with open(path, "rb") as f:
+            while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                yield chunk
+        yield tail
+
+    req = urllib.request.Request(f"http://{SERVER_ADDRESS}/upload/image", data=body(), headers={
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Length": str(len(head) + path.stat().st_size + len(tail)),
+    })
+    with urllib.request.urlopen(req) as response:
+        result = json.loads(response.read())
+    if result.get("name") != name:
+        raise RuntimeError(f"ComfyUI stored input {name} as {result.get('name')}")
+
+def ensure_inputs(prompt):
+    # Upload transport: copy the prompt's stored inputs that SERVER_ADDRESS does not have yet
+    if INPUT_TRANSPORT != "upload":
+        return
+    for name in prompt_inputs(prompt):
+        if uploaded_inputs.get(name) is None:
+            if not has_input(name):
+                upload_input(name)
+            uploaded_inputs.put(name, True)
+
+def view_connection():
+    connection = getattr(_view_connections, "connection", None)
+    if connection is None:
+        connection = _view_connections.connection = http.client.HTTPConnection(SERVER_ADDRESS, timeout=60)
+    return connection
 
 def get_image(filename, subfolder, folder_type):
     data = {"filename": filename, "type": folder_type}
     if subfolder:
         data["subfolder"] = subfolder
-    url_values = urllib.parse.urlencode(data)
-    try:
-        with urllib.request.urlopen(f"http://{SERVER_ADDRESS}/view?{url_values}") as response:
-            return response.read()
-    except Exception as e:
-        print(f"Error retrieving image: {e}")
-        return None
+    url = f"/view?{urllib.parse.urlencode(data)}"
+    # A kept-alive connection the server has since closed fails on first use; retry once on a new one
+    for attempt in range(2):
+        connection = view_connection()
+        try:
+            connection.request("GET", url)
+            response = connection.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError) as e:
+            connection.close()
+            _view_connections.connection = None
+            if attempt:
+                print(f"Error retrieving image: {e}")
+                return None
+            continue
+        if response.status != 200:
+            print(f"Error retrieving image: HTTP {response.status} for {filename}")
+            return None
+        return body
 
 # Get images url
 def get_image_url(filename, subfolder, folder_type):
@@ -57,97 +146,121 @@ def get_history(prompt_id):
         print(f"Error retrieving history: {e}")
         return {}
 
-def get_images(ws, prompt):
-    prompt_id = queue_prompt(prompt).get("prompt_id")
+def get_images(ws, prompt, request_id, listener=None):
+    try:
+        ensure_inputs(prompt)
+    except Exception as e:
+        print(f"Error uploading inputs: {e}")
+        return None, {}
+    prompt_id = queue_prompt(prompt, request_id).get("prompt_id")
     output_images = {}
+    if not prompt_id:
+        return None, output_images
 
+    # SaveImageWebsocket nodes send their images as binary frames while they execute
+    websocket_nodes = {node_id for node_id, node in prompt.items() if node.get("class_type") == WEBSOCKET_SAVE_NODE}
+    current_node = None
     while True:
         try:
             out = ws.recv()
             if isinstance(out, str):
                 message = json.loads(out)
-                if message["type"] == "executing" and message["data"].get("node") is None and message["data"].get("prompt_id") == prompt_id:
-                    break
+                if listener is not None and isinstance(message.get("data"), dict) and message["data"].get("prompt_id") == prompt_id:
+                    listener(message)
+                if message["type"] == "executing" and message["data"].get("prompt_id") == prompt_id:
+                    current_node = message["data"].get("node")
+                    if current_node is None:
+                        break
+            elif current_node in websocket_nodes and len(out) > 8:
+                # 4-byte event type and 4-byte image format precede the encoded image
+                output_images.setdefault(current_node, []).append(out[8:])
         except websocket.WebSocketException as e:
             print(f"WebSocket error: {e}")
             break
 
+    if websocket_nodes:
+        return prompt_id, output_images
+
     history = get_history(prompt_id).get(prompt_id, {})
-    for node_id, node_output in history.get("outputs", {}).items():
-        if "images" in node_output:
-            images_output = []
-            for image in node_output["images"]:
-                image_data = get_image(image.get("filename"), image.get("subfolder"), image.get("type"))
-                if image_data:
-                    images_output.append(image_data)
-            output_images[node_id] = images_output
-
-    return output_images
-
-def save_images_to_db(client_id, prompt_id, images):
-    if not images:
-        return
-    conn = psycopg2.connect(**DB_CONFIG)
-    cursor = conn.cursor()
-    image_records = []
-    
-    # Prepare the results directory
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())
-    result_dir = Path(RESULTS_PATH)
-    result_dir.mkdir(exist_ok=True)
+    files = [
+        (node_id, image)
+        for node_id, node_output in history.get("outputs", {}).items()
+        for image in node_output.get("images", [])
+    ]
+    # Outputs ComfyUI wrote on this host are used where they are; the rest are downloaded in parallel
+    sources = [None] * len(files)
+    if OUTPUT_TRANSPORT == "local":
+        sources = [path if path.is_file() else None for path in (local_output_path(image) for _, image in files)]
+    missing = [index for index, source in enumerate(sources) if source is None]
+    downloaded = _downloads.map(lambda image: get_image(image.get("filename"), image.get("subfolder"), image.get("type")),
+                                [files[index][1] for index in missing])
+    for index, image_data in zip(missing, downloaded):
+        sources[index] = image_data
+    for (node_id, _), source in zip(files, sources):
+        images_output = output_images.setdefault(node_id, [])
+        if source:
+            images_output.append(source)
 
-    try:
-        for image in images:
-            # Save the image to RESULTS_PATH
-            image_output_path = result_dir / f"result_{client_id}_{timestamp}_{unique_id}.png"
-            image.save(image_output_path, format="PNG")
-            
-            # Prepare the image data for database insertion
-            image_bytes = io.BytesIO()
-            image.save(image_bytes, format="PNG")
-            image_data = image_bytes.getvalue()
-            
-            image_records.append((
-                client_id,
-                prompt_id,
-                str(image_output_path),
-                len(image_data),
-                f"image/{image.format.lower()}",
-                datetime.utcnow()
-            ))
-        
-        if image_records:
-            insert_query = """
-            INSERT INTO generated_images (client_id, prompt_id, image_output_path, file_size, file_type, upload_time)
-            VALUES %s
-            """
-            execute_values(cursor, insert_query, image_records)
-            conn.commit()
-    except Exception as e:
-        print(f"An error occurred during database operation: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    return prompt_id, output_images
+
+def save_images_to_db(client_id, prompt_id, images, workflow=None, keep_slots=False):
+    """
+    Stores result images and queues their generated_images rows. `images` may hold PIL
+    images, encoded bytes or paths of files ComfyUI wrote on this host (see output_store).
+    Returns the rows of the images that were stored or, with `keep_slots`, one entry per
+    image in `images`, None where it is missing or could not be stored.
+    """
+    # Encode each image at most once, in parallel; the stored size is that of the written file
+    written = save_outputs(write_outputs(images, client_id, output_format(workflow)))
+    stored = [entry for entry in written if entry is not None]
+    rows = []
+    if stored:
+        schedule_thumbnails((path for path, _, _ in stored), after=get_result_storage().release)
+        try:
+            image_records = [
+                (client_id, prompt_id, result_relative_path(path.name), size, mime, datetime.utcnow(), workflow)
+                for path, size, mime in stored
+            ]
+            # Journaled and inserted by the background writer, batched with other requests' rows
+            rows = get_result_writer().submit(image_records)
+        except Exception as e:
+            print(f"An error occurred during database operation: {e}")
+    if not keep_slots:
+        return rows
+    if not rows:
+        return [None] * len(written)
+    submitted = iter(rows)
+    return [next(submitted) if entry is not None else None for entry in written]
 
-def get_prompt_images(prompt):
+def progress_listener(progress):
+    """Adapts a gr.Progress tracker into a get_prompt_images listener."""
+    def listener(message):
+        data = message["data"]
+        if message["type"] == "progress" and data.get("max"):
+            progress((data["value"], data["max"]), desc=f"Node {data.get('node')}", unit="steps")
+        elif message["type"] == "execution_start":
+            progress(0, desc="Running")
+    return listener
+
+def get_prompt_images(prompt, request_id, listener=None, workflow=None):
     ws = websocket.WebSocket()
     try:
         ws.connect(f"ws://{SERVER_ADDRESS}/ws?clientId={client_id}")
-        images = get_images(ws, prompt)
+        prompt_id, images = get_images(ws, prompt, request_id, listener)
+        sources = [source for image_data_list in images.values() for source in image_data_list]
+
+        # Persist against the prompt we actually waited on; never queue the graph a second time.
+        # Paths and encoded bytes are linked or stored as they are, without a decode and re-encode
+        if prompt_id:
+            save_images_to_db(client_id, prompt_id, sources, workflow)
+
+        # Only the gallery needs decoded images
         outputs = []
-        
-        for node_id, image_data_list in images.items():
-            for image_data in image_data_list:
-                try:
-                    image = Image.open(io.BytesIO(image_data))
-                    outputs.append(image)
-                except Exception as e:
-                    print(f"Error processing image for node {node_id}: {e}")
-
-        prompt_id = queue_prompt(prompt).get("prompt_id")
-        save_images_to_db(client_id, prompt_id, outputs)
+        for source in sources:
+            try:
+                outputs.append(Image.open(source if isinstance(source, Path) else io.BytesIO(source)))
+            except Exception as e:
+                print(f"Error processing image: {e}")
         return outputs
     except Exception as e:
         print(f"Error managing WebSocket connection: {e}")
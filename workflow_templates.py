@@ -0,0 +1,308 @@
+import os
+import json
+import hashlib
+import time
+import logging
+import threading
+from settings import (CLOTH_SWAP_WORKFLOW, EXPRESSION_WORKFLOW, CLOTH_BACKGROUND_WORKFLOW, HAIR_WORKFLOW, MAKEUP_WORKFLOW,
+                      EYEDETAILS_WORKFLOW, EYE_LIP_FACE_WORKFLOW, FLUX_CHARACTER_FACE_WORKFLOW, TEMPLATE_RELOAD_CHECK_INTERVAL,
+                      OUTPUT_TRANSPORT)
+
+logger = logging.getLogger(__name__)
+
+# Workflow file, the node inputs each handler is allowed to patch (checked when the file is loaded),
+# the (node, input) holding the sampler seed, used by deterministic mode, and the longest side input
+# images are downscaled to before submission. That is the size the graph works at where it resizes
+# internally (Hair.json resizes to 1500, the cloth segmenters cap at 2 MP, about 1632x1224) and
+# 2048 elsewhere, which only touches oversized phone photos. "sweep" maps the endpoint parameters a
+# sweep may vary to the (node, input) they set.
+WORKFLOW_TEMPLATES = {
+    "cloth-swap": {
+        "path": CLOTH_SWAP_WORKFLOW,
+        "seed": ("1", "seed"),
+        "max_side": 1632,
+        "patches": {
+            "1": ["seed"],
+            "13": ["top_clothes", "bottom_clothes", "torso_skin", "left_arm", "right_arm", "left_leg", "right_leg"],
+            "17": ["image"],
+            "18": ["image"],
+        },
+    },
+    "expression-edit": {
+        "path": EXPRESSION_WORKFLOW,
+        "seed": None,
+        "max_side": 2048,
+        "patches": {
+            "14": ["rotate_pitch", "rotate_yaw", "rotate_roll", "blink", "eyebrow", "wink",
+                   "pupil_x", "pupil_y", "aaa", "eee", "woo", "smile"],
+            "15": ["image"],
+        },
+        "sweep": {
+            name: ("14", name)
+            for name in ["rotate_pitch", "rotate_yaw", "rotate_roll", "blink", "eyebrow", "wink",
+                         "pupil_x", "pupil_y", "aaa", "eee", "woo", "smile"]
+        },
+    },
+    "cloth-background": {
+        "path": CLOTH_BACKGROUND_WORKFLOW,
+        "seed": ("3", "seed"),
+        "max_side": 1632,
+        "patches": {
+            "3": ["seed"],
+            "6": ["prompt"],
+            "1": ["image"],
+            "49": ["image"],
+            "37": ["image"],
+        },
+    },
+    "makeup-edit": {
+        "path": MAKEUP_WORKFLOW,
+        "seed": ("7", "seed"),
+        "max_side": 2048,
+        "patches": {
+            "7": ["seed"],
+            "13": ["denoise"],
+            "9": ["makeup_style", "eyeshadow", "eyeliner", "mascara", "blush", "lipstick", "lip_gloss"],
+            "1": ["image"],
+        },
+        "sweep": {
+            "slider": ("13", "denoise"),
+            **{name: ("9", name) for name in ["makeup_style", "eyeshadow", "eyeliner", "mascara", "blush", "lipstick", "lip_gloss"]},
+        },
+    },
+    "eye_details-edit": {
+        "path": EYEDETAILS_WORKFLOW,
+        "seed": ("8", "seed"),
+        "max_side": 2048,
+        "patches": {
+            "8": ["seed"],
+            "5": ["freckles", "eyes_details", "iris_details", "circular_iris", "circular_pupil"],
+            "1": ["image"],
+        },
+        "sweep": {name: ("5", name) for name in ["freckles", "eyes_details", "iris_details", "circular_iris", "circular_pupil"]},
+    },
+    "eye_lip_face-edit": {
+        "path": EYE_LIP_FACE_WORKFLOW,
+        "seed": ("27", "seed"),
+        "max_side": 2048,
+        "patches": {
+            "27": ["seed", "denoise"],
+            "21": ["face_shape_weight", "eyes_color", "eyes_shape", "lips_color", "lips_shape", "face_shape"],
+            "14": ["image"],
+        },
+        "sweep": {
+            "slider": ("21", "face_shape_weight"),
+            **{name: ("21", name) for name in ["eyes_color", "eyes_shape", "lips_color", "lips_shape", "face_shape"]},
+        },
+    },
+    "hair-edit": {
+        "path": HAIR_WORKFLOW,
+        "seed": ("156", "seed"),
+        "max_side": 1500,
+        "patches": {
+            "156": ["seed", "denoise"],
+            "228": ["text"],
+            "138": ["image"],
+        },
+        "sweep": {"slider": ("156", "denoise")},
+    },
+    "character-generation": {
+        "path": FLUX_CHARACTER_FACE_WORKFLOW,
+        "seed": ("25", "noise_seed"),
+        "max_side": 2048,
+        "patches": {
+            "25": ["noise_seed"],
+            "113": ["text"],
+            "79": ["text"],
+            "42": ["image"],
+            "85": ["image"],
+        },
+    },
+}
+
+# Terminal nodes that write result images; with OUTPUT_TRANSPORT "websocket" they are swapped for
+# SaveImageWebsocket, which sends the PNG bytes over the client's socket instead of to disk
+SAVE_NODES = {"SaveImage", "PreviewImage", "CPackOutputImage"}
+WEBSOCKET_SAVE_NODE = "SaveImageWebsocket"
+
+def is_link(value):
+    # Node inputs wired to another node's output are [source node id, output index]
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+
+def websocket_outputs(prompt):
+    """Copy of `prompt` whose terminal save nodes stream their images over the WebSocket."""
+    consumed = {
+        value[0]
+        for node in prompt.values()
+        for value in node.get("inputs", {}).values()
+        if is_link(value)
+    }
+    rewritten = dict(prompt)
+    for node_id, node in prompt.items():
+        if node.get("class_type") in SAVE_NODES and node_id not in consumed and "images" in node.get("inputs", {}):
+            rewritten[node_id] = {"class_type": WEBSOCKET_SAVE_NODE, "inputs": {"images": node["inputs"]["images"]}}
+    return rewritten
+
+def sweep_prompt(prompt, variants):
+    """
+    One prompt running every variant ({node_id: {input: value}}) of `prompt`. Only the patched
+    nodes and everything downstream of them are copied per variant, as "<node_id>_sweep<n>";
+    the upstream nodes (image loading, checkpoints, encoders) are shared, so ComfyUI runs them
+    once. Save nodes that no variant changes are dropped, and the remaining ones come in variant
+    order, which is the order get_prompt_images returns their images in.
+    """
+    branched = {node_id for variant in variants for node_id in variant}
+    # Nodes are not topologically ordered in workflow files, so spread until nothing changes
+    spreading = True
+    while spreading:
+        spreading = False
+        for node_id, node in prompt.items():
+            if node_id not in branched and any(is_link(value) and value[0] in branched for value in node["inputs"].values()):
+                branched.add(node_id)
+                spreading = True
+
+    swept = {
+        node_id: node
+        for node_id, node in prompt.items()
+        if node_id not in branched and node.get("class_type") not in SAVE_NODES | {WEBSOCKET_SAVE_NODE}
+    }
+    for index, variant in enumerate(variants):
+        for node_id, node in prompt.items():
+            if node_id not in branched:
+                continue
+            inputs = {
+                name: [f"{value[0]}_sweep{index}", value[1]] if is_link(value) and value[0] in branched else value
+                for name, value in node["inputs"].items()
+            }
+            swept[f"{node_id}_sweep{index}"] = {**node, "inputs": {**inputs, **variant.get(node_id, {})}}
+    return swept
+
+class WorkflowTemplate:
+    """
+    A workflow file parsed once and reused for every request.
+
+    render() builds a per-request prompt by copying the top-level dict and only the nodes
+    being patched; every other node dict is shared with the template, so callers must treat
+    rendered prompts as read-only outside the nodes they patched.
+    """
+
+    def __init__(self, name, path, patches, seed=None, max_side=None, sweep=None):
+        self.name = name
+        self.path = path
+        self.patches = {node_id: set(inputs) for node_id, inputs in patches.items()}
+        self.seed = seed
+        self.max_side = max_side
+        self.sweep = sweep or {}
+        for param, (node_id, input_name) in self.sweep.items():
+            if input_name not in self.patches.get(node_id, ()):
+                raise KeyError(f"Workflow {name}: sweep parameter {param} sets {node_id}.{input_name}, which is not a declared patch.")
+        self.prompt = None
+        self.websocket_prompt = None
+        self.digest = None
+        self.mtime = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path, "rb") as f:
+            raw = f.read()
+        prompt = json.loads(raw.decode("utf-8"))
+        self.validate(prompt)
+        # The digest identifies this exact version of the graph, e.g. in result cache keys
+        self.prompt, self.websocket_prompt = prompt, websocket_outputs(prompt)
+        self.mtime, self.digest = mtime, hashlib.sha256(raw).hexdigest()
+        self.checked_at = time.monotonic()
+
+    def validate(self, prompt):
+        for node_id, inputs in self.patches.items():
+            if node_id not in prompt or "inputs" not in prompt[node_id]:
+                raise KeyError(f"Workflow {self.path}: node '{node_id}' is missing.")
+            missing = inputs - set(prompt[node_id]["inputs"])
+            if missing:
+                raise KeyError(f"Workflow {self.path}: node '{node_id}' ({prompt[node_id].get('class_type')}) has no input(s) {sorted(missing)}.")
+
+    def refresh(self):
+        # Hot-reload when the file changes; stat at most once per TEMPLATE_RELOAD_CHECK_INTERVAL
+        now = time.monotonic()
+        if now - self.checked_at < TEMPLATE_RELOAD_CHECK_INTERVAL:
+            return
+        with self.lock:
+            self.checked_at = now
+            try:
+                if os.stat(self.path).st_mtime_ns != self.mtime:
+                    self.load()
+                    logger.info(f"Reloaded workflow template {self.name} from {self.path}")
+            except Exception as e:
+                logger.error(f"Keeping previous version of workflow {self.name}, reload failed: {e}")
+
+    def render(self, values):
+        """Returns a new prompt with `values` ({node_id: {input: value}}) applied."""
+        self.refresh()
+        prompt = dict(self.websocket_prompt if OUTPUT_TRANSPORT == "websocket" else self.prompt)
+        for node_id, inputs in values.items():
+            allowed = self.patches.get(node_id)
+            if allowed is None or not allowed.issuperset(inputs):
+                raise KeyError(f"Workflow {self.name}: patching {node_id}.{sorted(inputs)} is not declared in WORKFLOW_TEMPLATES.")
+            node = dict(prompt[node_id])
+            node["inputs"] = {**node["inputs"], **inputs}
+            prompt[node_id] = node
+        return prompt
+
+    def render_sweep(self, values, variants):
+        """Renders `values`, then branches the graph into `variants` (see sweep_prompt)."""
+        for variant in variants:
+            for node_id, inputs in variant.items():
+                if not self.patches.get(node_id, set()).issuperset(inputs):
+                    raise KeyError(f"Workflow {self.name}: sweeping {node_id}.{sorted(inputs)} is not declared in WORKFLOW_TEMPLATES.")
+        return sweep_prompt(self.render(values), variants)
+
+templates = {}
+_templates_lock = threading.Lock()
+
+def get_template(name):
+    template = templates.get(name)
+    if template is None:
+        with _templates_lock:
+            template = templates.get(name)
+            if template is None:
+                spec = WORKFLOW_TEMPLATES[name]
+                template = templates[name] = WorkflowTemplate(name, spec["path"], spec["patches"], spec.get("seed"),
+                                                              spec.get("max_side"), spec.get("sweep"))
+    return template
+
+def load_templates():
+    # Called at startup so a broken workflow file or node id fails fast instead of on first request
+    for name in WORKFLOW_TEMPLATES:
+        get_template(name)
+
+def render_workflow(name, values):
+    return get_template(name).render(values)
+
+def render_sweep(name, values, variants):
+    return get_template(name).render_sweep(values, variants)
+
+def _legacy_render(path, values):
+    # What the handlers did before the registry: parse the file on every request, then patch it
+    with open(path, "r", encoding="utf-8") as f:
+        prompt = json.load(f)
+    for node_id, inputs in values.items():
+        prompt[node_id]["inputs"].update(inputs)
+    return prompt
+
+if __name__ == "__main__":
+    import timeit
+
+    load_templates()
+    runs = 2000
+    sample_values = {
+        "hair-edit": {"156": {"seed": 1, "denoise": 0.5}, "228": {"text": "Sleek Bob, with Red hair color"}, "138": {"image": "img.jpg"}},
+        "character-generation": {"25": {"noise_seed": 1}, "113": {"text": "a man"}, "79": {"text": "armor"}, "42": {"image": "a.jpg"}, "85": {"image": "b.jpg"}},
+        "cloth-background": {"3": {"seed": 1}, "6": {"prompt": "clothing"}, "1": {"image": "a.jpg"}, "49": {"image": "b.jpg"}, "37": {"image": "c.jpg"}},
+    }
+    for name, values in sample_values.items():
+        path = WORKFLOW_TEMPLATES[name]["path"]
+        legacy = timeit.timeit(lambda: _legacy_render(path, values), number=runs) / runs * 1e6
+        compiled = timeit.timeit(lambda: render_workflow(name, values), number=runs) / runs * 1e6
+        print(f"{name:<22} load+patch {legacy:8.1f} us   compiled {compiled:6.1f} us   speedup {legacy / compiled:5.1f}x")